@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import logging.config
+import os
+import threading
+import time
+
+import googlemaps
+import numpy as np
+import yaml
+from addict import Dict as Addict
+
+from api_executor import ConcurrentExecutor, is_retriable
+from distance_api_worker import make_workers
+from mock_gmaps_server import MockBehavior, MockGMapsServer, load_places
+from places_api_worker import PlacesAPIWorker, load_grids
+
+MOCK_API_KEY = "AIzaMockKeyForLocalBenchmarks"
+
+
+class CallRecorder:
+    def __init__(self, executor):
+        """Initialization.
+        @param executor: ConcurrentExecutor running the calls, whose retry
+            policy decides when a failure is final
+
+        """
+        self.executor = executor
+        self.attempts = {}
+        self.started_at = {}
+        self.latencies = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def run(self, worker):
+        """Run the worker, recording the latency of the whole call including
+        retries, and count the failures the executor will not retry.
+        """
+        key = id(worker)
+        with self.lock:
+            started_at = self.started_at.setdefault(key, time.monotonic())
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        try:
+            result = worker.run()
+        except Exception as exc:
+            if is_retriable(exc) and attempt < self.executor.max_retries:
+                raise
+            logging.debug("Call failed: %r", exc)
+            result = None
+            with self.lock:
+                self.failures += 1
+        with self.lock:
+            self.latencies.append(time.monotonic() - started_at)
+            del self.started_at[key]
+            del self.attempts[key]
+        return result
+
+
+def summarize(latencies, elapsed_time):
+    latencies = np.asarray(latencies, dtype=float) * 1000
+    if not len(latencies):
+        latencies = np.zeros(1)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "throughput": round(len(latencies) / elapsed_time, 2),
+        "latency_p50_ms": round(p50, 2),
+        "latency_p95_ms": round(p95, 2),
+        "latency_p99_ms": round(p99, 2),
+        "latency_max_ms": round(latencies.max(), 2),
+    }
+
+
+def make_benchmark_workers(workload, gmaps, grids, supermarkets, conf, batch_conf):
+    """Workers of places_api_worker or distance_api_worker for a workload."""
+    if workload == "places":
+        return [
+            PlacesAPIWorker(gmaps, grid, query, conf.get("radius", 2000))
+            for grid in grids
+            for query in conf.get("places_query", "supermarket").split(",")
+        ]
+    if workload == "distance_matrix":
+        return list(make_workers(gmaps, grids, supermarkets, batch_conf))
+    raise ValueError("Unknown workload: %s" % workload)
+
+
+def run_scenario(server, scenario, workload, grids, supermarkets, conf):
+    """Run one workload through the existing workers against the mock server
+    and return its metrics.
+    """
+    server.reset(MockBehavior.from_conf(scenario, server.behavior.places))
+    executor = ConcurrentExecutor.from_conf(scenario.get("executor"))
+    gmaps = googlemaps.Client(
+        key=MOCK_API_KEY,
+        base_url=server.base_url,
+        queries_per_second=scenario.get("executor", {}).get("qps") or 60,
+        retry_over_query_limit=scenario.get("client_retry", True),
+        retry_timeout=scenario.get("client_retry_timeout", 60),
+    )
+    recorder = CallRecorder(executor)
+    workers = make_benchmark_workers(
+        workload, gmaps, grids, supermarkets, conf, scenario.get("batch", {})
+    )
+    start_time = time.monotonic()
+    for _ in executor.map(recorder.run, workers):
+        pass
+    elapsed_time = time.monotonic() - start_time
+    requests = server.counters.get("requests", 0)
+    result = {
+        "scenario": scenario.get("name"),
+        "workload": workload,
+        "calls": len(workers),
+        "failures": recorder.failures,
+        "requests": requests,
+        "executor_retries": executor.retries,
+        "client_retries": requests - len(workers) - executor.retries,
+        "injected_errors": server.counters.get("errors", 0),
+        "injected_over_query_limit": server.counters.get("over_query_limit", 0),
+        "elapsed_time": round(elapsed_time, 4),
+    }
+    result.update(summarize(recorder.latencies, elapsed_time))
+    return result
+
+
+def main(config_file):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    input_conf = conf.get("input")
+    grids = load_grids(input_conf.get("grid_geocode_file"))
+    if input_conf.get("num_grids"):
+        grids = grids[: int(input_conf.get("num_grids"))]
+    supermarkets = load_grids(input_conf.get("supermarkets_file"))
+    logging.info(
+        "Benchmarking with %s grids and %s supermarkets", len(grids), len(supermarkets)
+    )
+
+    server_conf = conf.get("server")
+    places = load_places(server_conf.get("places_file"))
+    server = MockGMapsServer(
+        (server_conf.get("host", "127.0.0.1"), int(server_conf.get("port", 0))),
+        MockBehavior(places=places),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info("Mock Google Maps server listening on %s", server.base_url)
+
+    results_fp = conf.get("output").get("benchmark_file")
+    if os.path.dirname(results_fp):
+        os.makedirs(os.path.dirname(results_fp), exist_ok=True)
+    try:
+        with open(results_fp, "a", encoding="utf-8") as results_file:
+            for scenario in conf.get("scenarios"):
+                for workload in conf.get("workloads"):
+                    result = run_scenario(
+                        server, scenario, workload, grids, supermarkets, input_conf
+                    )
+                    result["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+                    logging.info(
+                        "%s / %s: %s calls/s, p50 %s ms, p95 %s ms, p99 %s ms, "
+                        "%s executor retries, %s client retries, %s failures",
+                        result["scenario"],
+                        result["workload"],
+                        result["throughput"],
+                        result["latency_p50_ms"],
+                        result["latency_p95_ms"],
+                        result["latency_p99_ms"],
+                        result["executor_retries"],
+                        result["client_retries"],
+                        result["failures"],
+                    )
+                    results_file.write(json.dumps(result) + "\n")
+    finally:
+        server.shutdown()
+        server.server_close()
+    logging.info("Benchmark results appended to %s", results_fp)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
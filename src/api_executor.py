@@ -0,0 +1,167 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import googlemaps
+from googlemaps.exceptions import ApiError, HTTPError, Timeout, TransportError
+
+RETRIABLE_API_STATUSES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """Initialization.
+        @param rate: tokens added per second, i.e. the sustained QPS
+        @param capacity: maximum burst size, defaults to one second of tokens
+
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retriable(exc):
+    """Whether a failed Google Maps call is worth retrying."""
+    if isinstance(exc, ApiError):
+        return exc.status in RETRIABLE_API_STATUSES
+    if isinstance(exc, HTTPError):
+        return exc.status_code >= 500
+    return isinstance(exc, (Timeout, TransportError))
+
+
+def make_client(key, conf=None):
+    """googlemaps client leaving retries to the ConcurrentExecutor: it does
+    not retry OVER_QUERY_LIMIT and gives up retrying 5xx responses after
+    client_retry_timeout seconds, raising errors the executor backs off on.
+    """
+    conf = conf or {}
+    return googlemaps.Client(
+        key=key,
+        queries_per_second=conf.get("qps") or 60,
+        retry_over_query_limit=False,
+        retry_timeout=conf.get("client_retry_timeout", 1),
+    )
+
+
+class ConcurrentExecutor:
+    def __init__(
+        self,
+        workers=1,
+        qps=None,
+        max_retries=3,
+        backoff_base=1.0,
+        backoff_max=60.0,
+        metrics=None,
+    ):
+        """Initialization.
+        @param workers: number of requests in flight
+        @param qps: queries per second shared by all workers, unlimited if None
+        @param max_retries: retries of a retriable failure before giving up
+        @param backoff_base: delay in seconds before the first retry
+        @param backoff_max: upper bound of the delay between retries
+        @param metrics: Metrics recording the latency of every attempt,
+            retries and failures, if given
+
+        """
+        self.workers = max(1, int(workers))
+        self.bucket = TokenBucket(qps) if qps else None
+        self.max_retries = int(max_retries)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.retries = 0
+        self.lock = threading.Lock()
+        self.metrics = metrics
+
+    @classmethod
+    def from_conf(cls, conf, metrics=None):
+        """Build an executor from the executor section of a config file."""
+        conf = conf or {}
+        return cls(
+            workers=conf.get("workers", 1),
+            qps=conf.get("qps"),
+            max_retries=conf.get("max_retries", 3),
+            backoff_base=conf.get("backoff_base", 1.0),
+            backoff_max=conf.get("backoff_max", 60.0),
+            metrics=metrics,
+        )
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def call(self, fn, *args):
+        """Run fn(*args) under the rate limit, retrying retriable failures
+        with exponential backoff and jitter.
+        """
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(*args)
+                self.record("api_calls", start)
+                return result
+            except Exception as exc:
+                self.record("api_errors", start)
+                if attempt >= self.max_retries or not is_retriable(exc):
+                    if self.metrics is not None:
+                        self.metrics.count("api_failures")
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(
+                    "Retriable error %r, retry %s in %s seconds",
+                    exc,
+                    attempt + 1,
+                    round(delay, 2),
+                )
+                with self.lock:
+                    self.retries += 1
+                if self.metrics is not None:
+                    self.metrics.count("api_retries")
+                attempt += 1
+                time.sleep(delay)
+
+    def record(self, counter, start):
+        if self.metrics is not None:
+            self.metrics.observe("api_call_seconds", time.perf_counter() - start)
+            self.metrics.count(counter)
+
+    def map(self, fn, items, limited=True):
+        """Apply fn to every item concurrently and yield the results in the
+        order of items. Only a bounded window of items is in flight, so items
+        may be a lazy generator. With limited False, fn is run as is, making
+        its requests through call itself.
+        """
+        window = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for item in items:
+                if limited:
+                    pending.append(pool.submit(self.call, fn, item))
+                else:
+                    pending.append(pool.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
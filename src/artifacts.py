@@ -0,0 +1,124 @@
+import logging
+import os
+
+import pandas as pd
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc")
+
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PARQUET_EXTENSIONS:
+        return "parquet"
+    if extension in ARROW_EXTENSIONS:
+        return "arrow"
+    return "csv"
+
+
+def read_table(path, columns=None, memory_map=False):
+    """Read a table artifact, in the format given by its extension: Parquet,
+    Arrow IPC or CSV. Columnar files can be memory-mapped instead of read.
+    """
+    fmt = file_format(path)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=columns, memory_map=memory_map)
+        return table.to_pandas()
+    if fmt == "arrow":
+        import pyarrow.feather as feather
+
+        return feather.read_table(
+            path, columns=columns, memory_map=memory_map
+        ).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def write_table(df, path):
+    """Write a table artifact in the format given by the extension of path."""
+    writer = TableWriter(path)
+    writer.write(df)
+    writer.close()
+
+
+class TableWriter:
+    def __init__(self, path):
+        """Initialization.
+        @param path: CSV, Parquet or Arrow IPC file, written chunk by chunk
+
+        """
+        self.path = path
+        self.format = file_format(path)
+        self.writer = None
+        self.num_rows = 0
+
+    def write(self, df):
+        if self.format == "csv":
+            df.to_csv(
+                self.path,
+                mode="a" if self.num_rows else "w",
+                header=not self.num_rows,
+                index=False,
+            )
+        else:
+            import pyarrow as pa
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = self.open(table.schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        self.num_rows += len(df)
+
+    def open(self, schema):
+        if self.format == "parquet":
+            import pyarrow.parquet as pq
+
+            return pq.ParquetWriter(self.path, schema)
+        import pyarrow as pa
+
+        return pa.ipc.new_file(self.path, schema)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def read_layer(path):
+    """Read a geometry layer from GeoParquet or any file readable by
+    geopandas, e.g. a shapefile.
+    """
+    import geopandas as gpd
+
+    if file_format(path) == "parquet":
+        return gpd.read_parquet(path)
+    return gpd.read_file(path)
+
+
+def write_layer(gdf, path):
+    """Write a geometry layer to GeoParquet or, by extension, any file format
+    supported by geopandas.
+    """
+    if file_format(path) == "parquet":
+        gdf.to_parquet(path)
+    else:
+        gdf.to_file(path)
+
+
+def layer_attributes(gdf):
+    """Attribute table of a geometry layer, without the geometry column."""
+    return pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+
+
+def export(conf, name, df=None, gdf=None):
+    """Write the optional CSV or shapefile copy of an output configured
+    under the export section.
+    """
+    path = (conf.get("export") or {}).get(name)
+    if not path:
+        return
+    if gdf is not None:
+        write_layer(gdf, path)
+    else:
+        write_table(df, path)
+    logging.info("%s exported to %s", name, path)
@@ -0,0 +1,312 @@
+import argparse
+import json
+import logging
+import logging.config
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import yaml
+from addict import Dict as Addict
+
+from artifacts import read_table
+from grid_index import GridIndex
+from projection import grid_bounds_lnglat
+
+MAX_RESULTS = 10000  # grids returned by a query
+
+
+def read_grid_layers(grid_file, layer_files):
+    """Grid cells in EPSG:3857, as given to grid_population_layer_builder,
+    with the attributes of the layer tables joined on the grid id. Missing
+    layer files are skipped. Returns the cells and the {path: mtime_ns} of
+    the files read, None for the missing ones.
+    """
+    files = {}
+    grids_df = pd.read_csv(grid_file, usecols=["id", "left", "top", "right", "bottom"])
+    files[grid_file] = os.stat(grid_file).st_mtime_ns
+    grids_df = grids_df.dropna()
+    grids_df["id"] = grids_df["id"].astype(np.int64)
+    for path in layer_files:
+        if not path or not os.path.exists(path):
+            logging.warning("Layer file %s not found, skipped", path)
+            files[path] = None
+            continue
+        files[path] = os.stat(path).st_mtime_ns
+        layer_df = read_table(path, memory_map=True)
+        layer_df["id"] = pd.to_numeric(layer_df["id"]).astype(np.int64)
+        columns = [c for c in layer_df.columns if c not in grids_df.columns]
+        grids_df = pd.merge(grids_df, layer_df[["id"] + columns], on="id", how="left")
+    return grids_df.reset_index(drop=True), files
+
+
+class DensityLayer:
+    def __init__(self, grids_df, files):
+        """Initialization.
+        @param grids_df: one row per grid with id, left_lng, bottom_lat,
+            right_lng, top_lat, center_lng, center_lat and the attributes
+            of the population and density layers
+        @param files: {path: mtime_ns} of the files the layer was read from,
+            None for the layer files missing at the time
+
+        """
+        self.records = grids_df.drop(
+            columns=["left_lng", "bottom_lat", "right_lng", "top_lat"]
+        )
+        self.columns = {
+            column: self.records[column].values
+            for column in self.records.columns
+            if pd.api.types.is_numeric_dtype(self.records[column])
+        }
+        self.center_lng = grids_df["center_lng"].values
+        self.center_lat = grids_df["center_lat"].values
+        self.index = GridIndex(
+            np.arange(len(grids_df)),
+            grids_df["left_lng"].values,
+            grids_df["bottom_lat"].values,
+            grids_df["right_lng"].values,
+            grids_df["top_lat"].values,
+        )
+        self.files = files
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, grid_file, layer_files):
+        grids_df, files = read_grid_layers(grid_file, layer_files)
+        (
+            grids_df["left_lng"],
+            grids_df["bottom_lat"],
+            grids_df["right_lng"],
+            grids_df["top_lat"],
+        ) = grid_bounds_lnglat(grids_df)
+        grids_df = grids_df.drop(columns=["left", "top", "right", "bottom"])
+        grids_df["center_lng"] = (grids_df["left_lng"] + grids_df["right_lng"]) / 2
+        grids_df["center_lat"] = (grids_df["top_lat"] + grids_df["bottom_lat"]) / 2
+        return cls(grids_df, files)
+
+    def is_stale(self):
+        """Whether any file was written or removed since the layer was read."""
+        for path, mtime_ns in self.files.items():
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                return True
+        return False
+
+    def rows(self, positions):
+        """JSON-ready records of the grids at positions."""
+        records = self.records.iloc[positions]
+        return json.loads(records.to_json(orient="records"))
+
+    def point(self, lat, lng):
+        position = self.index.query([lng], [lat])[0]
+        return self.rows([position])[0] if position >= 0 else None
+
+    def within(self, min_lat, min_lng, max_lat, max_lng):
+        """Positions of the grids whose center is inside the bounding box."""
+        return np.flatnonzero(
+            (self.center_lat >= min_lat)
+            & (self.center_lat <= max_lat)
+            & (self.center_lng >= min_lng)
+            & (self.center_lng <= max_lng)
+        )
+
+    def top(self, column, n, positions=None, ascending=False):
+        """Positions of the n grids of largest value of column, or smallest
+        if ascending, among positions if given. Grids without a value are
+        left out.
+        """
+        if column not in self.columns:
+            raise KeyError(column)
+        values = self.columns[column].astype(float)
+        if positions is None:
+            positions = np.arange(len(values))
+        positions = positions[~np.isnan(values[positions])]
+        keys = values[positions] if ascending else -values[positions]
+        if n < len(positions):
+            selected = np.argpartition(keys, n)[:n]
+            positions, keys = positions[selected], keys[selected]
+        return positions[np.argsort(keys, kind="stable")]
+
+
+class DensityHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        start = time.perf_counter()
+        layer = self.server.layer
+        try:
+            if url.path == "/point":
+                record = layer.point(float(params["lat"]), float(params["lng"]))
+                if record is None:
+                    self.send_json(404, {"error": "no grid at this location"})
+                    return
+                body = {"grid": record}
+            elif url.path == "/bbox":
+                positions = layer.within(*bbox_params(params))
+                limit = count_param(params, "limit", MAX_RESULTS)
+                body = {
+                    "count": len(positions),
+                    "grids": layer.rows(positions[:limit]),
+                }
+            elif url.path == "/top":
+                positions = None
+                if "min_lat" in params:
+                    positions = layer.within(*bbox_params(params))
+                positions = layer.top(
+                    params.get("by", "density"),
+                    count_param(params, "n", 10),
+                    positions,
+                    params.get("order", "desc") == "asc",
+                )
+                body = {"grids": layer.rows(positions)}
+            elif url.path == "/health":
+                body = {
+                    "grids": len(layer.records),
+                    "columns": list(layer.records.columns),
+                    "loaded_at": time.strftime(
+                        "%Y-%m-%dT%H:%M:%S", time.localtime(layer.loaded_at)
+                    ),
+                    "files": sorted(layer.files),
+                }
+            else:
+                self.send_json(404, {"error": "unknown path %s" % url.path})
+                return
+        except (KeyError, ValueError) as exc:
+            self.send_json(400, {"error": "invalid query: %s" % exc})
+            return
+        body["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        self.send_json(200, body)
+
+    def send_json(self, status_code, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        # The map page is opened from the file system
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def count_param(params, key, default):
+    """Number of grids asked for, at most MAX_RESULTS."""
+    value = int(params.get(key, default))
+    if value < 0:
+        raise ValueError("%s must not be negative" % key)
+    return min(value, MAX_RESULTS)
+
+
+def bbox_params(params):
+    bounds = [
+        float(params[key]) for key in ("min_lat", "min_lng", "max_lat", "max_lng")
+    ]
+    if not all(math.isfinite(value) for value in bounds):
+        raise ValueError("bounding box must be finite")
+    return bounds
+
+
+class DensityServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, grid_file, layer_files, reload_interval=5):
+        """Initialization.
+        @param address: (host, port), port 0 picks a free port
+        @param grid_file: CSV of the grid cells in EPSG:3857
+        @param layer_files: population and density tables joined on grid id
+        @param reload_interval: seconds between checks for rewritten files,
+            no reload if 0
+
+        """
+        super().__init__(address, DensityHandler)
+        self.grid_file = grid_file
+        self.layer_files = list(layer_files)
+        self.layer = DensityLayer.load(grid_file, self.layer_files)
+        self.reload_interval = float(reload_interval)
+        self.stopped = threading.Event()
+        if self.reload_interval > 0:
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def watch(self):
+        """Reload the layer when the pipeline rewrites any of its files.
+        Queries keep being served from the previous layer until the new one
+        is swapped in.
+        """
+        while not self.stopped.wait(self.reload_interval):
+            if not self.layer.is_stale():
+                continue
+            try:
+                layer = DensityLayer.load(self.grid_file, self.layer_files)
+            except Exception:
+                # Files may be half written, retry on the next check
+                logging.exception("Reload failed, keeping the loaded layer")
+                continue
+            self.layer = layer
+            logging.info("Layer reloaded with %s grids", len(layer.records))
+
+    def server_close(self):
+        self.stopped.set()
+        super().server_close()
+
+
+def main(config_file):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    server_conf = conf.get("server", {})
+    input_conf = conf.get("input")
+    start_time = time.time()
+    server = DensityServer(
+        (server_conf.get("host", "127.0.0.1"), int(server_conf.get("port", 8050))),
+        input_conf.get("grid_file"),
+        [
+            input_conf.get("grid_population_file"),
+            input_conf.get("supermarket_density_file"),
+        ],
+        server_conf.get("reload_interval", 5),
+    )
+    logging.info(
+        "%s grids loaded ... Elapsed time %s seconds",
+        len(server.layer.records),
+        round(time.time() - start_time, 4),
+    )
+    logging.info("Density service listening on %s", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
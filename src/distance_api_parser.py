@@ -3,103 +3,237 @@ import json
 import logging
 import logging.config
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-import shapefile as shp
 import yaml
 from addict import Dict as Addict
 
-from osm_preprocessor import read_shapefile
+from artifacts import (
+    TableWriter,
+    export,
+    layer_attributes,
+    read_layer,
+    read_table,
+    write_layer,
+    write_table,
+)
+from metrics import Metrics
+from travel_time_matrix import TravelTimeMatrix
 
+RECORD_COLUMNS = ["grid_id", "supermarket_id", "status", "distance", "driving_time"]
+RECORD_TYPES = {
+    "grid_id": str,
+    "supermarket_id": str,
+    "status": str,
+    "distance": float,
+    "driving_time": float,
+}
 
-def catch_supermarkets(grid_id, dist_df, max_driving_time):
-    caught_dist_df = dist_df.loc[
-        (dist_df["grid_id"] == grid_id) & (dist_df["driving_time"] <= max_driving_time)
-    ]
-    return caught_dist_df.shape[0]
+
+def compute_density(grid_ids, grid_population, supermarket_counts):
+    """Population per reachable supermarket, or the whole population of the
+    grid when no supermarket is reachable.
+    """
+    counts = np.zeros(len(grid_ids), dtype=np.int64)
+    known = grid_ids < len(supermarket_counts)
+    counts[known] = supermarket_counts[grid_ids[known]]
+    return grid_population.astype(float) / np.maximum(counts, 1)
+
+
+def iter_json_array(f, buffer_size=1 << 20):
+    """Decode the elements of a JSON array one at a time, holding only a
+    bounded buffer of the file in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(buffer_size).lstrip()
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError("Buffer exhausted")
+            element, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            more = f.read(buffer_size)
+            if not more:
+                raise
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield element
+        pos = end
+        if pos > buffer_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+
+def iter_responses(raw_file):
+    """Yield the raw distance query responses one at a time, from a JSONL file
+    written by distance_api_worker or a legacy JSON array.
+    """
+    with open(raw_file, encoding="utf-8") as f:
+        if raw_file.endswith(".json"):
+            yield from iter_json_array(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_record_chunks(raw_file, chunk_size):
+    """Yield the parsed distance records as DataFrames of chunk_size rows."""
+    records = []
+    for dist_raw in iter_responses(raw_file):
+        records.append(parse_response(dist_raw))
+        if len(records) >= chunk_size:
+            yield pd.DataFrame(records, columns=RECORD_COLUMNS).astype(RECORD_TYPES)
+            records = []
+    if records:
+        yield pd.DataFrame(records, columns=RECORD_COLUMNS).astype(RECORD_TYPES)
 
 
-def compute_density(grid_id, grid_population, supermarket_counts):
-    if int(grid_id) not in supermarket_counts:
-        return float(grid_population) / 1
-    return float(grid_population) / int(supermarket_counts[grid_id])
+def parse_response(dist_raw):
+    dist_obj = {}
+    dist_obj["grid_id"] = dist_raw["grid_id"]
+    dist_obj["supermarket_id"] = dist_raw["supermarket_id"]
+    dist_obj["status"] = dist_raw["status"]
+    dist_obj["distance"] = None
+    dist_obj["driving_time"] = None
+    if dist_raw.get("rows"):
+        row = dist_raw.get("rows")[0]
+        if row.get("elements"):
+            element = row.get("elements")[0]
+            if element.get("distance"):
+                dist_obj["distance"] = element.get("distance").get("value")
+            if element.get("duration"):
+                dist_obj["driving_time"] = element.get("duration").get("value")
+    return dist_obj
 
 
-def main(config_file):
-    conf = Addict(yaml.safe_load(open(config_file, "r")))
+def threshold_column(threshold):
+    """Name of the density column of a threshold in seconds, e.g. density_10min."""
+    return "density_%smin" % ("%g" % (float(threshold) / 60))
+
+
+def main(config_file, profile=False):
+    """Parse the distance responses into densities, config_file being the
+    path of the config or the config itself, as passed by region_runner.
+    """
+    if isinstance(config_file, dict):
+        conf = Addict(config_file)
+    else:
+        conf = Addict(yaml.safe_load(open(config_file, "r")))
     if conf.get("logging") is not None:
         logging.config.dictConfig(conf["logging"])
     else:
         logging.basicConfig(
             level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
         )
+    metrics = Metrics.from_conf(conf.get("metrics"), "distance_api_parser", profile)
+    metrics.start_stage("parse_responses")
     raw_file = conf.get("output").get("grid_to_supermarket_dist_raw")
-    dist_data = []
-    with open(raw_file, encoding="utf-8") as f:
-        for dist_raw in json.loads(f.read()):
-            dist_obj = {}
-            dist_obj["grid_id"] = dist_raw["grid_id"]
-            dist_obj["supermarket_id"] = dist_raw["supermarket_id"]
-            dist_obj["status"] = dist_raw["status"]
-            if dist_raw.get("rows"):
-                row = dist_raw.get("rows")[0]
-                if row.get("elements"):
-                    element = row.get("elements")[0]
-                    if element.get("distance"):
-                        dist_obj["distance"] = element.get("distance").get("value")
-                    else:
-                        dist_obj["distance"] = None
-
-                    if element.get("duration"):
-                        dist_obj["driving_time"] = element.get("duration").get("value")
-                    else:
-                        dist_obj["driving_time"] = None
-            else:
-                dist_obj["distance"] = None
-                dist_obj["driving_time"] = None
-            dist_data.append(dist_obj)
-    dist_df = pd.DataFrame(dist_data)
     output_file = conf.get("output").get("grid_to_supermarket_dist_data")
-    dist_df.to_csv(output_file, index=False)
-    logging.info("%s distance query results written to %s", len(dist_data), output_file)
-
-    supermarket_counts = {}
     max_driving_time = int(conf.get("max_driving_time"))
-    for grid_id in dist_df["grid_id"].unique():
-        supermarket_counts[grid_id] = catch_supermarkets(
-            grid_id, dist_df, max_driving_time
+    chunk_size = int(conf.get("parse_chunk_size", 100000))
+    # Only the routed pairs are kept for the matrix, with compact types and
+    # the supermarket ids as codes of store_codes
+    columns = {"grid_id": [], "supermarket_id": [], "driving_time": [], "distance": []}
+    store_codes = {}
+    writer = TableWriter(output_file)
+    for dist_df in iter_record_chunks(raw_file, chunk_size):
+        writer.write(dist_df)
+        metrics.count("rows_parsed", len(dist_df))
+        dist_df = dist_df.loc[dist_df["driving_time"].notna()]
+        for store_id in pd.unique(dist_df["supermarket_id"]):
+            store_codes.setdefault(store_id, len(store_codes))
+        columns["grid_id"].append(
+            pd.to_numeric(dist_df["grid_id"]).values.astype(np.int64)
+        )
+        columns["supermarket_id"].append(
+            dist_df["supermarket_id"].map(store_codes).values.astype(np.int32)
         )
+        for name in ("driving_time", "distance"):
+            columns[name].append(dist_df[name].values.astype(np.float32))
+    writer.close()
+    logging.info(
+        "%s distance query results written to %s", writer.num_rows, output_file
+    )
 
+    metrics.start_stage("build_matrix")
+    matrix = TravelTimeMatrix.from_records(
+        *(
+            np.concatenate(columns[name]) if columns[name] else np.zeros(0, np.int64)
+            for name in ("grid_id", "supermarket_id", "driving_time", "distance")
+        ),
+        store_values=list(store_codes),
+    )
+    del columns
+    logging.info(
+        "Travel time matrix of %s grids x %s supermarkets with %s routed pairs",
+        len(matrix.grid_ids),
+        len(matrix.store_ids),
+        matrix.nnz,
+    )
+    matrix_file = conf.get("output").get("travel_time_matrix_file")
+    if matrix_file:
+        matrix.save(matrix_file)
+        logging.info("Travel time matrix saved to %s", matrix_file)
+
+    metrics.start_stage("compute_density")
     population_file = conf.get("input").get("grid_population_file")
     logging.info("Loading simulated population of city grids from %s", population_file)
-    population_df = pd.read_csv(population_file)
-    population_df["density"] = population_df.apply(
-        lambda pop: compute_density(pop["id"], pop["population"], supermarket_counts),
-        axis=1,
+    population_df = read_table(
+        population_file, columns=["id", "population"], memory_map=True
     )
-    density_df = population_df[["id", "density"]]
+    thresholds = [max_driving_time] + [
+        threshold
+        for threshold in conf.get("density_thresholds") or []
+        if threshold != max_driving_time
+    ]
+    grid_ids = population_df["id"].values.astype(np.int64)
+    densities = matrix.density(grid_ids, population_df["population"].values, thresholds)
+    population_df["density"] = densities[:, 0]
+    density_columns = ["density"]
+    for i, threshold in enumerate(thresholds[1:], 1):
+        population_df[threshold_column(threshold)] = densities[:, i]
+        density_columns.append(threshold_column(threshold))
+    accessibility_conf = conf.get("accessibility")
+    if accessibility_conf:
+        population_df["accessibility"] = matrix.accessibility(
+            grid_ids,
+            accessibility_conf.get("decay", "exponential"),
+            accessibility_conf.get("scale", 600),
+        )
+        density_columns.append("accessibility")
+    density_df = population_df[["id"] + density_columns]
 
+    metrics.start_stage("write_outputs")
     grid_shape = conf.get("input").get("grid_shape_file")
-    sf = shp.Reader(grid_shape)
-    shp_df = read_shapefile(sf)
+    gdf = read_layer(grid_shape).to_crs(epsg=3857)
+    shp_df = layer_attributes(gdf)
     logging.info("Shape of shp_df: %s", shp_df.shape)
     logging.info(shp_df.head())
     density_shp_df = pd.merge(
         shp_df, density_df, left_on="id", right_on="id", how="outer"
     )
-    density_shp_df = density_shp_df.drop("coords", axis=1)
-    logging.info("Export supermarket density to text file")
+    logging.info("Export supermarket density to table file")
     supermarket_density_file = conf.get("output").get("supermarket_density_file")
-    density_shp_df.to_csv(supermarket_density_file, index=False)
+    write_table(density_shp_df, supermarket_density_file)
+    export(conf, "supermarket_density_file", df=density_shp_df)
     logging.info(density_shp_df.head())
-    gdf = gpd.read_file(grid_shape)
-    gdf = gdf.to_crs({"init": "epsg:3857"})
     gdf["density"] = density_shp_df["density"]
     supermarket_density_shape_file = conf.get("output").get(
         "supermarket_density_shape_file"
     )
-    gdf.to_file(supermarket_density_shape_file)
+    write_layer(gdf, supermarket_density_shape_file)
+    export(conf, "supermarket_density_shape_file", gdf=gdf)
     logging.info("Supermarket density added to the shape file of city grid layer")
+    metrics.write()
 
 
 if __name__ == "__main__":
@@ -107,9 +241,14 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c", "--config", required=True, help="directory of the config file"
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
     args = parser.parse_args()
     try:
-        main(args.config)
+        main(args.config, profile=args.profile)
     except Exception:
         logging.exception("Unhandled error during processing")
         raise
@@ -3,12 +3,26 @@ import csv
 import json
 import logging
 import logging.config
-import time
+import os
 
-import googlemaps
+import numpy as np
 import yaml
 from addict import Dict as Addict
 
+from api_executor import ConcurrentExecutor, make_client
+from metrics import Metrics
+from response_cache import CachedClient, ResponseCache
+from road_network import RoadNetworkBackend
+from spatial_prefilter import find_candidates, search_radius
+from travel_time_estimator import (
+    ESTIMATED_STATUS,
+    TravelTimeEstimator,
+    count_error,
+    grid_attributes,
+    pair_distances,
+    training_pairs,
+)
+
 
 class DistAPIWorker:
     def __init__(self, gmaps, city_grid, supermarket):
@@ -33,7 +47,376 @@ class DistAPIWorker:
         return response
 
 
-def main(config_file):
+class BatchDistAPIWorker:
+    def __init__(self, gmaps, city_grids, supermarkets):
+        """Initialization.
+        @param gmaps
+        @param city_grids: origins packed into one request
+        @param supermarkets: destinations packed into one request
+
+        """
+        self.gmaps = gmaps
+        self.city_grids = city_grids
+        self.supermarkets = supermarkets
+
+    def run(self):
+        grid_geocodes = [
+            (city_grid["center_lat"], city_grid["center_lng"])
+            for city_grid in self.city_grids
+        ]
+        supermarket_geocodes = [
+            (supermarket["lat"], supermarket["lng"])
+            for supermarket in self.supermarkets
+        ]
+        response = self.gmaps.distance_matrix(
+            grid_geocodes, supermarket_geocodes, mode="driving"
+        )
+        return split_matrix_response(response, self.city_grids, self.supermarkets)
+
+
+def split_matrix_response(response, city_grids, supermarkets):
+    """Split a many-to-many Distance Matrix response into one response per
+    (grid, supermarket) pair, shaped like the response of a 1 x 1 request.
+    """
+    origin_addresses = response.get("origin_addresses") or []
+    destination_addresses = response.get("destination_addresses") or []
+    rows = response.get("rows") or []
+    results = []
+    for i, city_grid in enumerate(city_grids):
+        elements = []
+        if i < len(rows):
+            elements = rows[i].get("elements") or []
+        for j, supermarket in enumerate(supermarkets):
+            pair_response = {
+                "destination_addresses": [],
+                "origin_addresses": [],
+                "rows": [],
+                "status": response.get("status"),
+                "grid_id": city_grid.get("id"),
+                "supermarket_id": supermarket.get("index"),
+            }
+            if i < len(origin_addresses):
+                pair_response["origin_addresses"].append(origin_addresses[i])
+            if j < len(destination_addresses):
+                pair_response["destination_addresses"].append(destination_addresses[j])
+            if j < len(elements):
+                pair_response["rows"].append({"elements": [elements[j]]})
+            results.append(pair_response)
+    return results
+
+
+def chunk(items, size):
+    for start in range(0, len(items), size):
+        stop = start + size
+        yield items[start:stop]
+
+
+def batch_shape(max_origins, max_destinations, max_elements):
+    """Pick the number of origins and destinations per request so that
+    origins x destinations stays within the element limit.
+    """
+    num_destinations = max(1, min(max_destinations, max_elements))
+    num_origins = max(1, min(max_origins, max_elements // num_destinations))
+    return num_origins, num_destinations
+
+
+def make_workers(gmaps, grids, supermarkets, batch_conf, completed=(), candidates=None):
+    """Yield one worker per API request, skipping the (grid_id, supermarket_id)
+    pairs in completed.
+
+    Single workers return one response, batch workers return a list of
+    per-pair responses. When candidates maps each grid id to the
+    supermarkets worth querying, batches hold one origin each, so that no
+    element is spent on a pair outside the candidates.
+    """
+    if candidates is None:
+        candidates = {grid.get("id"): supermarkets for grid in grids}
+        sparse = False
+    else:
+        sparse = True
+
+    if not batch_conf.get("enabled"):
+        for grid in grids:
+            for supermarket in candidates.get(grid.get("id"), []):
+                if (grid.get("id"), supermarket.get("index")) in completed:
+                    continue
+                yield DistAPIWorker(gmaps, grid, supermarket)
+        return
+
+    num_origins, num_destinations = batch_shape(
+        int(batch_conf.get("max_origins", 25)),
+        int(batch_conf.get("max_destinations", 25)),
+        int(batch_conf.get("max_elements", 100)),
+    )
+    if sparse:
+        for grid in grids:
+            remaining = [
+                supermarket
+                for supermarket in candidates.get(grid.get("id"), [])
+                if (grid.get("id"), supermarket.get("index")) not in completed
+            ]
+            for supermarket_chunk in chunk(remaining, num_destinations):
+                yield BatchDistAPIWorker(gmaps, [grid], supermarket_chunk)
+        return
+
+    for grid_chunk in chunk(grids, num_origins):
+        for supermarket_chunk in chunk(supermarkets, num_destinations):
+            if completed:
+                supermarket_chunk = [
+                    supermarket
+                    for supermarket in supermarket_chunk
+                    if any(
+                        (grid.get("id"), supermarket.get("index")) not in completed
+                        for grid in grid_chunk
+                    )
+                ]
+                if not supermarket_chunk:
+                    continue
+            yield BatchDistAPIWorker(gmaps, grid_chunk, supermarket_chunk)
+
+
+class GoogleDistanceBackend:
+    def __init__(self, gmaps, executor, batch_conf):
+        """Initialization.
+        @param gmaps: googlemaps client, optionally behind a CachedClient
+        @param executor: ConcurrentExecutor running the requests
+        @param batch_conf: batch section of the config
+
+        """
+        self.gmaps = gmaps
+        self.executor = executor
+        self.batch_conf = batch_conf
+
+    def iter_responses(self, grids, supermarkets, completed=(), candidates=None):
+        """Yield one response per (grid, supermarket) pair not in completed,
+        querying only the candidates when given.
+        """
+        workers = make_workers(
+            self.gmaps, grids, supermarkets, self.batch_conf, completed, candidates
+        )
+        for response in self.executor.map(lambda worker: worker.run(), workers):
+            if isinstance(response, list):
+                yield from response
+            else:
+                yield response
+
+
+def unreachable_response(city_grid, supermarket):
+    """Record of a pair too far apart to be within max_driving_time, which
+    is never sent to the API.
+    """
+    return {
+        "destination_addresses": [],
+        "origin_addresses": [],
+        "rows": [],
+        "status": "UNREACHABLE",
+        "grid_id": city_grid.get("id"),
+        "supermarket_id": supermarket.get("index"),
+    }
+
+
+def estimated_response(city_grid, supermarket, driving_time):
+    """Record of a pair clearly within max_driving_time by the estimator,
+    which is never sent to the API.
+    """
+    return {
+        "destination_addresses": [],
+        "origin_addresses": [],
+        "rows": [
+            {
+                "elements": [
+                    {"duration": {"value": int(round(driving_time))}, "status": "OK"}
+                ]
+            }
+        ],
+        "status": ESTIMATED_STATUS,
+        "grid_id": city_grid.get("id"),
+        "supermarket_id": supermarket.get("index"),
+    }
+
+
+def density_thresholds(conf):
+    """max_driving_time and the density thresholds, the driving times the
+    parser counts supermarkets within.
+    """
+    thresholds = [conf.get("max_driving_time")] + list(
+        conf.get("density_thresholds") or []
+    )
+    return sorted({float(threshold) for threshold in thresholds})
+
+
+def estimate_candidates(
+    backend, writer, grids, supermarkets, candidates, conf, results_fp, metrics
+):
+    """Two-stage querying: fit a TravelTimeEstimator on the responses of a
+    random sample of the candidate pairs, or of an earlier run, and record
+    the pairs whose band is clearly on one side of max_driving_time and of
+    every density threshold without querying them. Returns the candidates
+    left to query, the borderline pairs.
+    """
+    estimator_conf = conf.get("estimator", {})
+    max_driving_time = float(conf.get("max_driving_time"))
+    thresholds = density_thresholds(conf)
+    grid_lat = np.array([float(grid["center_lat"]) for grid in grids])
+    grid_lng = np.array([float(grid["center_lng"]) for grid in grids])
+    store_lat = np.array([float(supermarket["lat"]) for supermarket in supermarkets])
+    store_lng = np.array([float(supermarket["lng"]) for supermarket in supermarkets])
+    store_positions = {
+        supermarket.get("index"): j for j, supermarket in enumerate(supermarkets)
+    }
+    pair_grids, pair_stores = [], []
+    for i, grid in enumerate(grids):
+        stores = supermarkets if candidates is None else candidates[grid.get("id")]
+        pair_grids += [i] * len(stores)
+        pair_stores += [store_positions[store.get("index")] for store in stores]
+    pair_grids = np.array(pair_grids, dtype=np.int64)
+    pair_stores = np.array(pair_stores, dtype=np.int64)
+
+    training_file = estimator_conf.get("training_file")
+    if not training_file:
+        rng = np.random.RandomState(estimator_conf.get("seed"))
+        sample_size = min(int(estimator_conf.get("sample_size", 2000)), len(pair_grids))
+        sample = rng.choice(len(pair_grids), sample_size, replace=False)
+        sample_candidates = {}
+        for i, j in zip(pair_grids[sample], pair_stores[sample]):
+            sample_candidates.setdefault(grids[i].get("id"), []).append(supermarkets[j])
+        for response in backend.iter_responses(
+            grids, supermarkets, writer.completed, sample_candidates
+        ):
+            if writer.write(response):
+                metrics.count("pairs_sampled")
+        # The sample is read back with the pairs of an interrupted run
+        writer.commit()
+        training_file = results_fp
+    trained_grids, trained_stores, times = training_pairs(
+        training_file,
+        {grid.get("id"): i for i, grid in enumerate(grids)},
+        store_positions,
+    )
+    attributes = grid_attributes(
+        conf.get("input").get("grid_population_file"),
+        estimator_conf.get("grid_attributes"),
+        [grid.get("id") for grid in grids],
+    )
+    estimator = TravelTimeEstimator.fit(
+        pair_distances(
+            grid_lat, grid_lng, store_lat, store_lng, trained_grids, trained_stores
+        ),
+        times,
+        None if attributes is None else attributes[trained_grids],
+        float(estimator_conf.get("coverage", 0.98)),
+    )
+    logging.info(
+        "Estimator fitted on %s routed pairs of %s, band x%s - x%s",
+        len(times),
+        training_file,
+        round(np.exp(estimator.lower), 3),
+        round(np.exp(estimator.upper), 3),
+    )
+
+    estimates, borderline = estimator.borderline(
+        pair_distances(
+            grid_lat, grid_lng, store_lat, store_lng, pair_grids, pair_stores
+        ),
+        thresholds,
+        None if attributes is None else attributes[pair_grids],
+    )
+    remaining = {grid.get("id"): [] for grid in grids}
+    for i, j, estimate, query in zip(
+        pair_grids.tolist(), pair_stores.tolist(), estimates, borderline
+    ):
+        grid, supermarket = grids[i], supermarkets[j]
+        if query:
+            remaining[grid.get("id")].append(supermarket)
+        elif estimate <= max_driving_time:
+            if writer.write(estimated_response(grid, supermarket, estimate)):
+                metrics.count("pairs_estimated")
+        elif writer.write(unreachable_response(grid, supermarket)):
+            metrics.count("pairs_unreachable")
+    logging.info(
+        "%s of %s candidate pairs are borderline and left to query",
+        int(borderline.sum()),
+        len(borderline),
+    )
+    return remaining
+
+
+def load_checkpoint(checkpoint_fp):
+    """Read the byte offset of the last committed response and the
+    (grid_id, supermarket_id) pairs completed up to that offset.
+    """
+    offset = 0
+    completed = set()
+    if not os.path.exists(checkpoint_fp):
+        return offset, completed
+    with open(checkpoint_fp, encoding="utf-8") as f:
+        for line in f:
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:
+                # Partially written checkpoint from an interrupted run
+                break
+            offset = checkpoint["offset"]
+            completed.update(tuple(pair) for pair in checkpoint["pairs"])
+    return offset, completed
+
+
+class ResponseWriter:
+    def __init__(self, results_fp, checkpoint_fp, checkpoint_every, resume=False):
+        """Initialization.
+        @param results_fp: append-only JSONL file, one response per line
+        @param checkpoint_fp: append-only JSONL file of committed pairs
+        @param checkpoint_every: number of responses between checkpoints
+        @param resume: continue from the last checkpoint instead of
+            starting over
+
+        """
+        self.checkpoint_every = int(checkpoint_every)
+        self.completed = set()
+        self.pending = []
+        self.counter = 0
+        offset = 0
+        if resume:
+            offset, self.completed = load_checkpoint(checkpoint_fp)
+        if resume and os.path.exists(results_fp):
+            # Drop responses written after the last checkpoint
+            self.output = open(results_fp, "r+b")
+            self.output.truncate(offset)
+            self.output.seek(offset)
+            self.checkpoint = open(checkpoint_fp, "a", encoding="utf-8")
+        else:
+            self.output = open(results_fp, "wb")
+            self.checkpoint = open(checkpoint_fp, "w", encoding="utf-8")
+
+    def write(self, response):
+        pair = (response["grid_id"], response["supermarket_id"])
+        if pair in self.completed:
+            return False
+        self.output.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.completed.add(pair)
+        self.pending.append(pair)
+        self.counter += 1
+        if len(self.pending) >= self.checkpoint_every:
+            self.commit()
+        return True
+
+    def commit(self):
+        """Persist the written responses, then record them as completed."""
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        checkpoint = {"offset": self.output.tell(), "pairs": self.pending}
+        self.checkpoint.write(json.dumps(checkpoint) + "\n")
+        self.checkpoint.flush()
+        os.fsync(self.checkpoint.fileno())
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.output.close()
+        self.checkpoint.close()
+
+
+def main(config_file, resume=False, profile=False):
     conf = Addict(yaml.safe_load(open(config_file, "r")))
     if conf.get("logging") is not None:
         logging.config.dictConfig(conf["logging"])
@@ -41,6 +424,8 @@ def main(config_file):
         logging.basicConfig(
             level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
         )
+    metrics = Metrics.from_conf(conf.get("metrics"), "distance_api_worker", profile)
+    metrics.start_stage("load_inputs")
     supermarkets_file = conf.get("input").get("supermarkets_file")
     logging.info("Loading geocode of supermarkets from %s", supermarkets_file)
     supermarkets_file_reader = csv.reader(open(supermarkets_file))
@@ -61,32 +446,126 @@ def main(config_file):
         grids.append(grid)
     logging.info("The city is covered by %s 1km x 1km grids.", len(grids))
 
-    api_key = conf.get("API").get("KEY")
-    gmaps = googlemaps.Client(key=api_key)
-    results = []
+    metrics.start_stage("build_backend")
+    travel_time_conf = conf.get("travel_time", {})
+    backend_name = travel_time_conf.get("backend", "google")
+    executor = None
+    cache = None
+    if backend_name == "road_network":
+        backend = RoadNetworkBackend.from_conf(
+            travel_time_conf.get("road_network"), conf.get("max_driving_time")
+        )
+    elif backend_name == "google":
+        executor = ConcurrentExecutor.from_conf(conf.get("executor"), metrics)
+        api_key = conf.get("API").get("KEY")
+        gmaps = make_client(api_key, conf.get("executor"))
+        cache = ResponseCache.from_conf(conf.get("cache"))
+        if cache is not None:
+            gmaps = CachedClient(gmaps, cache)
+        backend = GoogleDistanceBackend(gmaps, executor, conf.get("batch", {}))
+    else:
+        raise ValueError("Unknown travel time backend: %s" % backend_name)
+
+    results_fp = conf.get("output").get("grid_to_supermarket_dist_raw")
+    writer = ResponseWriter(
+        results_fp,
+        conf.get("output").get("grid_to_supermarket_dist_checkpoint"),
+        conf.get("checkpoint_every", 1000),
+        resume=resume,
+    )
+    if resume:
+        logging.info(
+            "Resuming with %s grid-supermarket pairs already processed",
+            len(writer.completed),
+        )
+    candidates = None
+    prefilter_conf = conf.get("prefilter", {})
+    if backend_name == "google" and prefilter_conf.get("enabled"):
+        metrics.start_stage("prefilter")
+        radius = search_radius(
+            conf.get("max_driving_time"), prefilter_conf.get("max_speed")
+        )
+        candidates = find_candidates(grids, supermarkets, radius)
+        num_candidates = sum(len(stores) for stores in candidates.values())
+        logging.info(
+            "%s of %s grid-supermarket pairs within %s meters, "
+            "the others are recorded as unreachable",
+            num_candidates,
+            len(grids) * len(supermarkets),
+            round(radius),
+        )
+        for grid in grids:
+            reachable = {
+                supermarket.get("index") for supermarket in candidates[grid.get("id")]
+            }
+            for supermarket in supermarkets:
+                if supermarket.get("index") not in reachable:
+                    if writer.write(unreachable_response(grid, supermarket)):
+                        metrics.count("pairs_unreachable")
+
+    estimator_conf = conf.get("estimator", {})
+    if backend_name == "google" and estimator_conf.get("enabled"):
+        metrics.start_stage("estimate")
+        candidates = estimate_candidates(
+            backend, writer, grids, supermarkets, candidates, conf, results_fp, metrics
+        )
+
+    metrics.start_stage("query")
     counter = 0
-    logging.info("Start querying driving time from city grid to supermarkets ...")
-    start_time = time.time()
-    for grid in grids:
-        for supermarket in supermarkets:
-            logging.debug("Processing grid: %s - supermarket: %s", grid, supermarket)
-            dist_api_worker = DistAPIWorker(gmaps, grid, supermarket)
-            response = dist_api_worker.run()
-            results.append(response)
+    logging.info(
+        "Start computing driving time from city grid to supermarkets "
+        "with the %s backend ...",
+        backend_name,
+    )
+    responses = backend.iter_responses(
+        grids, supermarkets, writer.completed, candidates
+    )
+    try:
+        for response in responses:
+            logging.debug(
+                "Processed grid: %s - supermarket: %s",
+                response["grid_id"],
+                response["supermarket_id"],
+            )
+            if not writer.write(response):
+                continue
             counter += 1
+            metrics.count("pairs_written")
             if counter % 1000 == 0:
                 logging.info(
                     "%s grid-supermarket pair processed ... Elapsed time %s seconds",
                     counter,
-                    round(time.time() - start_time, 4),
+                    metrics.elapsed(),
                 )
+    finally:
+        writer.close()
+    metrics.stop_stage()
+    logging.info("%s query responses written to %s", writer.counter, results_fp)
+
+    reference_file = estimator_conf.get("reference_file")
+    if backend_name == "google" and estimator_conf.get("enabled") and reference_file:
+        metrics.start_stage("count_error")
+        error = count_error(results_fp, reference_file, density_thresholds(conf))
+        logging.info("Supermarket counts against %s: %s", reference_file, error)
+        for threshold, threshold_error in error.items():
+            for name, value in threshold_error.items():
+                metrics.gauge("count_%s_%g" % (name, threshold), value)
+        metrics.stop_stage()
 
-    # Export query responses to file
-    if len(results) > 0:
-        results_fp = conf.get("output").get("grid_to_supermarket_dist_raw")
-        with open(results_fp, "w") as output_file:
-            json.dump(results, output_file, indent=4)
-        logging.info("%s query responses dumped to %s", len(results), results_fp)
+    if executor is not None:
+        logging.info("%s requests retried", executor.retries)
+    if cache is not None:
+        logging.info(
+            "Response cache: %s hits, %s misses, hit rate %s",
+            cache.hits,
+            cache.misses,
+            round(cache.hit_rate(), 4),
+        )
+        metrics.gauge("cache_hits", cache.hits)
+        metrics.gauge("cache_misses", cache.misses)
+        metrics.gauge("cache_hit_rate", round(cache.hit_rate(), 4))
+        cache.close()
+    metrics.write()
 
 
 if __name__ == "__main__":
@@ -94,9 +573,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c", "--config", required=True, help="directory of the config file"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the grid-supermarket pairs of the last checkpoint",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
     args = parser.parse_args()
     try:
-        main(args.config)
+        main(args.config, resume=args.resume, profile=args.profile)
     except Exception:
         logging.exception("Unhandled error during processing")
         raise
@@ -0,0 +1,83 @@
+from itertools import chain
+
+import numpy as np
+
+WGS84_RADIUS = 6378137  # Radius of earth in meter, as used by the area package
+
+
+def pack_polygons(coords_list):
+    """Pack a list of polygons, each a list of (lng, lat) points, into a flat
+    (N, 2) point buffer and M + 1 offsets delimiting the polygons.
+    """
+    lengths = np.fromiter((len(coords) for coords in coords_list), dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    points = np.fromiter(
+        chain.from_iterable(chain.from_iterable(coords_list)),
+        dtype=float,
+        count=2 * offsets[-1],
+    )
+    return points.reshape(-1, 2), offsets
+
+
+def ring_positions(offsets):
+    """Polygon of each point, its position within that polygon and the
+    number of points of that polygon.
+    """
+    lengths = np.diff(offsets)
+    polygon = np.repeat(np.arange(len(lengths)), lengths)
+    position = np.arange(offsets[-1]) - offsets[polygon]
+    return polygon, position, lengths[polygon]
+
+
+def polygon_centroids(points, offsets):
+    """Geometric center of each polygon, the mean of its points without the
+    closing point. Matches osm_preprocessor.get_center to within 1e-12
+    degree; polygons of a single point get NaN.
+    """
+    num_polygons = len(offsets) - 1
+    polygon, position, length = ring_positions(offsets)
+    weights = (position < length - 1).astype(float)
+    num_points = np.diff(offsets) - 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lng = (
+            np.bincount(polygon, weights=points[:, 0] * weights, minlength=num_polygons)
+            / num_points
+        )
+        lat = (
+            np.bincount(polygon, weights=points[:, 1] * weights, minlength=num_polygons)
+            / num_points
+        )
+    return np.column_stack([lng, lat])
+
+
+def polygon_areas(points, offsets):
+    """Geodesic area in square meter of each polygon taken as a single ring,
+    with the spherical formula of the area package (Chamberlain & Duquette,
+    2007). Within a relative error of 1e-9 of the exact value of that
+    formula; osm_preprocessor.calc_floor_area loses precision on small
+    polygons and differs by up to 1e-7 for buildings 3e-5 degree across,
+    3e-7 at 1e-5 degree and about 1e-9 from 1e-4 degree.
+    """
+    num_polygons = len(offsets) - 1
+    polygon, position, length = ring_positions(offsets)
+    start = offsets[polygon]
+    middle = start + (position + 1) % length
+    upper = start + (position + 2) % length
+    # The longitude steps of a ring sum to 0, so the sine of the latitude of
+    # its first point can be taken off each term. Without it the terms are
+    # large and of opposite signs, and small buildings lose precision; the
+    # differences of nearby coordinates in degree are exact
+    lng_steps = np.deg2rad(points[upper, 0] - points[:, 0])
+    lat = points[middle, 1]
+    lat_start = points[start, 1]
+    sin_steps = (
+        2
+        * np.cos(np.deg2rad(lat + lat_start) / 2)
+        * np.sin(np.deg2rad(lat - lat_start) / 2)
+    )
+    terms = lng_steps * sin_steps
+    areas = np.abs(np.bincount(polygon, weights=terms, minlength=num_polygons))
+    areas *= WGS84_RADIUS * WGS84_RADIUS / 2
+    areas[np.diff(offsets) <= 2] = 0
+    return areas
@@ -0,0 +1,161 @@
+import numpy as np
+
+
+def locate(values, edges):
+    """Index of the interval of edges holding each value, -1 outside.
+
+    Evenly spaced edges are resolved by arithmetic, others by binary search.
+    """
+    values = np.asarray(values, dtype=float)
+    num_cells = len(edges) - 1
+    steps = np.diff(edges)
+    if num_cells > 0 and np.allclose(steps, steps[0], rtol=1e-9, atol=0):
+        index = np.floor((values - edges[0]) / steps[0])
+        index[np.isnan(index)] = -1
+        index = np.clip(index, -1, num_cells).astype(int)
+        # Undo floating point rounding next to the edges
+        inside = (index >= 0) & (index < num_cells)
+        clipped = np.clip(index, 0, max(num_cells - 1, 0))
+        index[inside & (values < edges[clipped])] -= 1
+        index[inside & (values >= edges[clipped + 1])] += 1
+    else:
+        index = np.searchsorted(edges, values, side="right") - 1
+    index[(index < 0) | (index >= num_cells)] = -1
+    return index
+
+
+class GridIndex:
+    def __init__(self, ids, left, bottom, right, top):
+        """Initialization.
+        @param ids: grid ids
+        @param left, bottom, right, top: boundaries of the grid cells
+
+        Cells forming a rectilinear lattice are located by their row and
+        column; any other layout falls back to buckets of a uniform grid,
+        each listing the cells overlapping it.
+
+        """
+        self.ids = np.asarray(ids, dtype=object)
+        self.left = np.asarray(left, dtype=float)
+        self.bottom = np.asarray(bottom, dtype=float)
+        self.right = np.asarray(right, dtype=float)
+        self.top = np.asarray(top, dtype=float)
+        self.lattice = self.build_lattice()
+        self.buckets = None
+        if self.lattice is None and len(self.ids):
+            self.buckets = self.build_buckets()
+
+    @classmethod
+    def from_frame(cls, df, left="left", bottom="bottom", right="right", top="top"):
+        """Index the cells of a DataFrame, identified by its index."""
+        return cls(df.index, df[left], df[bottom], df[right], df[top])
+
+    def build_lattice(self):
+        x_edges = np.unique(np.concatenate([self.left, self.right]))
+        y_edges = np.unique(np.concatenate([self.bottom, self.top]))
+        columns = np.searchsorted(x_edges, self.left)
+        rows = np.searchsorted(y_edges, self.bottom)
+        if len(self.ids) == 0 or not (
+            np.array_equal(
+                x_edges[np.minimum(columns + 1, len(x_edges) - 1)], self.right
+            )
+            and np.array_equal(
+                y_edges[np.minimum(rows + 1, len(y_edges) - 1)], self.top
+            )
+        ):
+            return None
+        cells = np.full((len(y_edges) - 1, len(x_edges) - 1), -1, dtype=np.int64)
+        # Overlapping cells resolve to the first one, as in a linear scan
+        cells[rows[::-1], columns[::-1]] = np.arange(len(self.ids))[::-1]
+        return x_edges, y_edges, cells
+
+    def build_buckets(self):
+        """Uniform grid of buckets about the median size of a cell, with the
+        positions of the cells overlapping each bucket sorted by bucket key,
+        in the order of the cells within a bucket.
+        """
+        x_origin, y_origin = self.left.min(), self.bottom.min()
+        width = np.median(self.right - self.left)
+        height = np.median(self.top - self.bottom)
+        width = width if width > 0 else max(self.right.max() - x_origin, 1.0)
+        height = height if height > 0 else max(self.top.max() - y_origin, 1.0)
+        first_column = np.floor((self.left - x_origin) / width).astype(np.int64)
+        last_column = np.floor((self.right - x_origin) / width).astype(np.int64)
+        first_row = np.floor((self.bottom - y_origin) / height).astype(np.int64)
+        last_row = np.floor((self.top - y_origin) / height).astype(np.int64)
+        num_columns = int(last_column.max()) + 1
+        # Every cell in every bucket it overlaps
+        spans = last_column - first_column + 1
+        sizes = spans * (last_row - first_row + 1)
+        cells = np.repeat(np.arange(len(self.ids)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        keys = (first_row[cells] + offsets // spans[cells]) * num_columns + (
+            first_column[cells] + offsets % spans[cells]
+        )
+        order = np.argsort(keys, kind="stable")
+        return x_origin, y_origin, width, height, num_columns, keys[order], cells[order]
+
+    def bucket_query(self, x, y):
+        """Position of the first cell strictly containing each point among
+        the cells of its bucket, -1 if none.
+        """
+        x_origin, y_origin, width, height, num_columns, keys, cells = self.buckets
+        positions = np.full(len(x), len(self.ids), dtype=np.int64)
+        with np.errstate(invalid="ignore"):
+            columns = np.floor((x - x_origin) / width)
+            rows = np.floor((y - y_origin) / height)
+        valid = (columns >= 0) & (columns < num_columns) & (rows >= 0)
+        columns = np.where(valid, columns, 0).astype(np.int64)
+        rows = np.where(valid, rows, 0).astype(np.int64)
+        points = np.flatnonzero(valid)
+        point_keys = rows[valid] * num_columns + columns[valid]
+        starts = np.searchsorted(keys, point_keys, side="left")
+        sizes = np.searchsorted(keys, point_keys, side="right") - starts
+        # Every point against every cell of its bucket
+        pairs = np.repeat(np.arange(len(points)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        candidates = cells[starts[pairs] + offsets]
+        points = points[pairs]
+        inside = (
+            (x[points] > self.left[candidates])
+            & (x[points] < self.right[candidates])
+            & (y[points] > self.bottom[candidates])
+            & (y[points] < self.top[candidates])
+        )
+        np.minimum.at(positions, points[inside], candidates[inside])
+        positions[positions == len(self.ids)] = -1
+        return positions
+
+    def query(self, x, y):
+        """Position of the cell strictly containing each point, -1 if none."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if self.lattice is not None:
+            x_edges, y_edges, cells = self.lattice
+            columns = locate(x, x_edges)
+            rows = locate(y, y_edges)
+            found = (columns >= 0) & (rows >= 0)
+            positions = np.full(len(x), -1, dtype=np.int64)
+            positions[found] = cells[rows[found], columns[found]]
+        elif self.buckets is not None:
+            positions = self.bucket_query(x, y)
+        else:
+            positions = np.full(len(x), -1, dtype=np.int64)
+        # Points on a cell boundary belong to no cell
+        found = positions >= 0
+        cell = positions[found]
+        inside = (
+            (x[found] > self.left[cell])
+            & (x[found] < self.right[cell])
+            & (y[found] > self.bottom[cell])
+            & (y[found] < self.top[cell])
+        )
+        positions[np.flatnonzero(found)[~inside]] = -1
+        return positions
+
+    def lookup(self, x, y):
+        """Id of the cell strictly containing each point, None if none."""
+        positions = self.query(x, y)
+        ids = np.empty(len(positions), dtype=object)
+        ids[positions >= 0] = self.ids[positions[positions >= 0]]
+        return ids
@@ -0,0 +1,201 @@
+import argparse
+import json
+import logging
+import logging.config
+import os
+import shutil
+
+import numpy as np
+import yaml
+from addict import Dict as Addict
+
+from density_service import read_grid_layers
+from metrics import Metrics
+from projection import WEB_MERCATOR, WGS84, transform_coords
+
+MERCATOR_ORIGIN = 20037508.342789244  # Half the width of the world in EPSG:3857
+TILE_EXTENT = 8192  # Quantization steps per tile side
+TILE_MAGIC = b"AGT1"
+
+
+def tile_size(zoom):
+    return 2 * MERCATOR_ORIGIN / (1 << zoom)
+
+
+def tile_of(x, y, zoom):
+    """Column and row of the slippy map tile holding each EPSG:3857 point,
+    rows counted from the top as in Google Maps and OSM tiles.
+    """
+    size = tile_size(zoom)
+    columns = np.floor((np.asarray(x) + MERCATOR_ORIGIN) / size).astype(np.int64)
+    rows = np.floor((MERCATOR_ORIGIN - np.asarray(y)) / size).astype(np.int64)
+    last = (1 << zoom) - 1
+    return np.clip(columns, 0, last), np.clip(rows, 0, last)
+
+
+def quantize(values, origin, size, extent=TILE_EXTENT):
+    """Position of EPSG:3857 coordinates within a tile, in 1/extent of the
+    tile side. Cells of a tile may stick out of it by up to three tile sides.
+    """
+    steps = np.round((np.asarray(values) - origin) / size * extent)
+    return np.clip(steps, -32768, 32767).astype("<i2")
+
+
+def encode_tile(ids, bounds, attributes, column, row, zoom, extent=TILE_EXTENT):
+    """Binary tile, little endian: magic, uint32 number of cells, uint16
+    number of attributes and uint16 padding, then columns of uint32 ids,
+    int16 left, bottom, right and top from the top-left corner of the tile
+    (y growing downwards), and float32 attribute values. Every column is
+    aligned to its item size, so that the page reads it as a typed array.
+    """
+    size = tile_size(zoom)
+    tile_left = column * size - MERCATOR_ORIGIN
+    tile_top = MERCATOR_ORIGIN - row * size
+    left, bottom, right, top = bounds
+    parts = [
+        TILE_MAGIC,
+        np.array([len(ids)], dtype="<u4").tobytes(),
+        np.array([len(attributes), 0], dtype="<u2").tobytes(),
+        np.asarray(ids, dtype="<u4").tobytes(),
+        quantize(left, tile_left, size, extent).tobytes(),
+        quantize(tile_top - np.asarray(bottom), 0, size, extent).tobytes(),
+        quantize(right, tile_left, size, extent).tobytes(),
+        quantize(tile_top - np.asarray(top), 0, size, extent).tobytes(),
+    ]
+    parts += [np.asarray(values, dtype="<f4").tobytes() for values in attributes]
+    return b"".join(parts)
+
+
+def value_range(values):
+    """5th and 95th percentile, the color scale of the map page."""
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return [0.0, 0.0]
+    return [float(v) for v in np.percentile(values, [5, 95])]
+
+
+def export_tiles(grids_df, attributes, index_file, zoom, extent=TILE_EXTENT):
+    """Write one tile of zoom per group of grid cells, by the tile holding
+    the cell center, under the directory of index_file listing the tiles.
+    Returns the index.
+    """
+    tiles_dir = os.path.dirname(index_file)
+    zoom_dir = os.path.join(tiles_dir, str(zoom))
+    if os.path.isdir(zoom_dir):
+        # Tiles of an earlier export may no longer have any grid
+        shutil.rmtree(zoom_dir)
+    columns, rows = tile_of(
+        (grids_df["left"].values + grids_df["right"].values) / 2,
+        (grids_df["bottom"].values + grids_df["top"].values) / 2,
+        zoom,
+    )
+    keys = columns * (1 << zoom) + rows
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    bounds = [grids_df[name].values for name in ("left", "bottom", "right", "top")]
+    values = [grids_df[name].values.astype(float) for name in attributes]
+    tiles = {}
+    num_bytes = 0
+    for start, end in zip(starts, ends):
+        cells = order[start:end]
+        column, row = divmod(int(keys[start]), 1 << zoom)
+        payload = encode_tile(
+            grids_df["id"].values[cells],
+            [b[cells] for b in bounds],
+            [v[cells] for v in values],
+            column,
+            row,
+            zoom,
+            extent,
+        )
+        path = os.path.join(zoom_dir, str(column), "%s.bin" % row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(payload)
+        tiles["%s/%s/%s" % (zoom, column, row)] = len(cells)
+        num_bytes += len(payload)
+    lng, lat = transform_coords(
+        [grids_df["left"].min(), grids_df["right"].max()],
+        [grids_df["bottom"].min(), grids_df["top"].max()],
+        WEB_MERCATOR,
+        WGS84,
+    )
+    index = {
+        "zoom": zoom,
+        "extent": extent,
+        "attributes": list(attributes),
+        "ranges": {name: value_range(v) for name, v in zip(attributes, values)},
+        "bounds": [float(lng[0]), float(lat[0]), float(lng[1]), float(lat[1])],
+        "tiles": tiles,
+    }
+    # Written last and atomically, so the page never sees missing tiles
+    with open(index_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(index_file + ".tmp", index_file)
+    logging.info(
+        "%s grids written to %s tiles of zoom %s, %s bytes",
+        len(grids_df),
+        len(tiles),
+        zoom,
+        num_bytes,
+    )
+    return index
+
+
+def main(config_file, profile=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    metrics = Metrics.from_conf(conf.get("metrics"), "map_tile_exporter", profile)
+    metrics.start_stage("load_layers")
+    input_conf = conf.get("input")
+    grids_df, _ = read_grid_layers(
+        input_conf.get("grid_file"),
+        [
+            input_conf.get("grid_population_file"),
+            input_conf.get("supermarket_density_file"),
+        ],
+    )
+    attributes = [
+        name for name in conf.get("tiles").get("attributes") if name in grids_df
+    ]
+    missing = set(conf.get("tiles").get("attributes")) - set(attributes)
+    if missing:
+        logging.warning("Attributes not in the layers, skipped: %s", sorted(missing))
+    logging.info("%s grids loaded with attributes %s", len(grids_df), attributes)
+
+    metrics.start_stage("export_tiles")
+    index = export_tiles(
+        grids_df,
+        attributes,
+        conf.get("output").get("index_file"),
+        int(conf.get("tiles").get("zoom", 10)),
+        int(conf.get("tiles").get("extent", TILE_EXTENT)),
+    )
+    metrics.gauge("tiles", len(index["tiles"]))
+    metrics.count("grids_exported", len(grids_df))
+    metrics.write()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, profile=args.profile)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
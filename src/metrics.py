@@ -0,0 +1,255 @@
+import bisect
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_PREFIX = "asiatique"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialization.
+        @param buckets: sorted upper bounds, an overflow bucket is added
+
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(
+                zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)
+            ),
+        }
+
+
+class Metrics:
+    def __init__(self, run, path=None, fmt="jsonl", profile=False, profile_dir=None):
+        """Initialization.
+        @param run: name of the script, labelling every metric
+        @param path: file the metrics are written to on write(), none if None
+        @param fmt: jsonl appends one record per run, prometheus rewrites a
+            text file for the node exporter textfile collector
+        @param profile: record cProfile stats and tracemalloc peak memory of
+            every stage
+        @param profile_dir: directory of the cProfile stats files
+
+        """
+        if fmt not in ("jsonl", "prometheus"):
+            raise ValueError("Unknown metrics format: %s" % fmt)
+        self.run = run
+        self.path = path
+        self.format = fmt
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.current = None
+        self.started_at = time.time()
+
+    @classmethod
+    def from_conf(cls, conf, run, profile=False):
+        """Build the metrics of a script from the metrics section of its config."""
+        conf = conf or {}
+        return cls(
+            run,
+            path=conf.get("path"),
+            fmt=conf.get("format", "jsonl"),
+            profile=profile,
+            profile_dir=conf.get("profile_dir", "log/profile"),
+        )
+
+    def start_stage(self, name):
+        """Start timing a stage, ending the one in progress if any."""
+        if self.current is not None:
+            self.stop_stage()
+        profiler = None
+        if self.profile:
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.current = (name, time.perf_counter(), profiler)
+
+    def stop_stage(self):
+        """End the stage in progress and log its elapsed time."""
+        name, start, profiler = self.current
+        self.current = None
+        stage = {"seconds": round(time.perf_counter() - start, 4)}
+        if profiler is not None:
+            profiler.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stage["peak_memory_mb"] = round(peak / 2**20, 2)
+            stage["profile"] = self.dump_profile(name, profiler)
+        self.stages[name] = stage
+        logging.info(
+            "Stage %s done ... Elapsed time %s seconds%s",
+            name,
+            stage["seconds"],
+            ", peak memory %s MB" % stage["peak_memory_mb"] if self.profile else "",
+        )
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        self.start_stage(name)
+        try:
+            yield self
+        finally:
+            self.stop_stage()
+
+    def elapsed(self):
+        """Seconds since the start of the stage in progress."""
+        if self.current is None:
+            return 0.0
+        return round(time.perf_counter() - self.current[1], 4)
+
+    def dump_profile(self, name, profiler):
+        """Write the cProfile stats of a stage, readable with pstats or
+        snakeviz. Only the calling thread is profiled.
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, "%s.%s.prof" % (self.run, name))
+        profiler.dump_stats(path)
+        return path
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Observe the duration of the block in the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "run": self.run,
+                "timestamp": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)
+                ),
+                "seconds": round(time.time() - self.started_at, 4),
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    name: histogram.to_dict()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        record = self.to_dict()
+        labels = 'run="%s"' % self.run
+        lines = ["# TYPE %s_stage_seconds gauge" % PROMETHEUS_PREFIX]
+        for name, stage in record["stages"].items():
+            lines.append(
+                '%s_stage_seconds{%s,stage="%s"} %s'
+                % (PROMETHEUS_PREFIX, labels, name, stage["seconds"])
+            )
+        if self.profile:
+            lines.append("# TYPE %s_stage_peak_memory_bytes gauge" % PROMETHEUS_PREFIX)
+        for name, stage in record["stages"].items():
+            if "peak_memory_mb" in stage:
+                lines.append(
+                    '%s_stage_peak_memory_bytes{%s,stage="%s"} %s'
+                    % (
+                        PROMETHEUS_PREFIX,
+                        labels,
+                        name,
+                        int(stage["peak_memory_mb"] * 2**20),
+                    )
+                )
+        for name, value in record["counters"].items():
+            metric = "%s_%s_total" % (PROMETHEUS_PREFIX, name)
+            lines += [
+                "# TYPE %s counter" % metric,
+                "%s{%s} %s" % (metric, labels, value),
+            ]
+        for name, value in record["gauges"].items():
+            metric = "%s_%s" % (PROMETHEUS_PREFIX, name)
+            lines += ["# TYPE %s gauge" % metric, "%s{%s} %s" % (metric, labels, value)]
+        for name, histogram in self.histograms.items():
+            metric = "%s_%s" % (PROMETHEUS_PREFIX, name)
+            lines.append("# TYPE %s histogram" % metric)
+            cumulative = 0
+            bounds = [str(b) for b in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append(
+                    '%s_bucket{%s,le="%s"} %s' % (metric, labels, bound, cumulative)
+                )
+            lines.append("%s_sum{%s} %s" % (metric, labels, histogram.sum))
+            lines.append("%s_count{%s} %s" % (metric, labels, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """End the stage in progress and write the metrics to path."""
+        if self.current is not None:
+            self.stop_stage()
+        if not self.path:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.format == "prometheus":
+            # Replace the file atomically so that the collector never
+            # reads a partial file
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp_path, self.path)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+        logging.info("Metrics written to %s", self.path)
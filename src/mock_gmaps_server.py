@@ -0,0 +1,292 @@
+import argparse
+import json
+import logging
+import logging.config
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import yaml
+from addict import Dict as Addict
+
+from spatial_prefilter import haversine
+
+PLACES_PATH = "/maps/api/place/textsearch/json"
+DISTANCE_MATRIX_PATH = "/maps/api/distancematrix/json"
+MAX_PLACES_RESULTS = 20  # results per page of the Places API
+MAX_PLACES_PAGES = 3  # pages of results per search of the Places API
+MAX_ELEMENTS = 100  # elements per request of the Distance Matrix API
+
+
+class LatencyModel:
+    def __init__(self, distribution="constant", **params):
+        """Initialization.
+        @param distribution: one of
+            constant (value), uniform (low, high),
+            lognormal (median, sigma) or exponential (mean),
+            with every parameter in seconds except sigma
+
+        """
+        if distribution not in ("constant", "uniform", "lognormal", "exponential"):
+            raise ValueError("Unknown latency distribution: %s" % distribution)
+        self.distribution = distribution
+        self.params = params
+
+    @classmethod
+    def from_conf(cls, conf):
+        conf = dict(conf or {})
+        return cls(conf.pop("distribution", "constant"), **conf)
+
+    def sample(self, rng):
+        if self.distribution == "uniform":
+            return rng.uniform(self.params.get("low", 0), self.params.get("high", 0))
+        if self.distribution == "lognormal":
+            median = self.params.get("median", 0.1)
+            return rng.lognormvariate(np.log(median), self.params.get("sigma", 0.5))
+        if self.distribution == "exponential":
+            return rng.expovariate(1 / self.params.get("mean", 0.1))
+        return self.params.get("value", 0)
+
+
+class MockBehavior:
+    def __init__(
+        self,
+        latency=None,
+        error_rate=0.0,
+        over_query_limit_rate=0.0,
+        places=(),
+        speed=40,
+        detour=1.4,
+        seed=None,
+    ):
+        """Initialization.
+        @param latency: LatencyModel of the response time
+        @param error_rate: share of requests answered with HTTP 500
+        @param over_query_limit_rate: share of requests answered with
+            status OVER_QUERY_LIMIT
+        @param places: canned Places API results, replayed by distance
+            to the requested location
+        @param speed: km/h of the simulated driving times
+        @param detour: ratio of simulated road distance to straight line
+        @param seed: seed of the random draws, for repeatable runs
+
+        """
+        self.latency = latency or LatencyModel()
+        self.error_rate = float(error_rate)
+        self.over_query_limit_rate = float(over_query_limit_rate)
+        self.places = list(places)
+        self.place_lat = np.array(
+            [place["geometry"]["location"]["lat"] for place in self.places]
+        )
+        self.place_lng = np.array(
+            [place["geometry"]["location"]["lng"] for place in self.places]
+        )
+        self.speed = float(speed)
+        self.detour = float(detour)
+        self.rng = random.Random(seed)
+
+    @classmethod
+    def from_conf(cls, conf, places=()):
+        """Build the behavior from a scenario section of a config file."""
+        conf = conf or {}
+        return cls(
+            latency=LatencyModel.from_conf(conf.get("latency")),
+            error_rate=conf.get("error_rate", 0),
+            over_query_limit_rate=conf.get("over_query_limit_rate", 0),
+            places=places,
+            speed=conf.get("speed", 40),
+            detour=conf.get("detour", 1.4),
+            seed=conf.get("seed"),
+        )
+
+    def places_response(self, params):
+        lat, lng = (float(v) for v in params["location"].split(","))
+        radius = float(params.get("radius", 50000))
+        if not self.places:
+            return {"html_attributions": [], "results": [], "status": "ZERO_RESULTS"}
+        distances = haversine(lat, lng, self.place_lat, self.place_lng)
+        nearest = np.argsort(distances)[: MAX_PLACES_RESULTS * MAX_PLACES_PAGES]
+        nearest = nearest[distances[nearest] <= radius]
+        # Page tokens encode the offset of the page in the results
+        offset = int(params.get("pagetoken", "page-0").split("-")[1])
+        end = offset + MAX_PLACES_RESULTS
+        page = nearest[offset:end]
+        response = {
+            "html_attributions": [],
+            "results": [self.places[i] for i in page],
+            "status": "OK" if len(page) else "ZERO_RESULTS",
+        }
+        if end < len(nearest):
+            response["next_page_token"] = "page-%s" % end
+        return response
+
+    def distance_matrix_response(self, params):
+        origins = [parse_latlng(v) for v in params["origins"].split("|")]
+        destinations = [parse_latlng(v) for v in params["destinations"].split("|")]
+        if len(origins) * len(destinations) > MAX_ELEMENTS:
+            return {
+                "destination_addresses": [],
+                "origin_addresses": [],
+                "rows": [],
+                "status": "MAX_ELEMENTS_EXCEEDED",
+            }
+        origin_lat, origin_lng = np.array(origins).T
+        destination_lat, destination_lng = np.array(destinations).T
+        distances = self.detour * haversine(
+            origin_lat[:, None],
+            origin_lng[:, None],
+            destination_lat[None, :],
+            destination_lng[None, :],
+        )
+        durations = distances / (self.speed / 3.6)
+        rows = []
+        for distance_row, duration_row in zip(distances, durations):
+            elements = [
+                {
+                    "distance": {
+                        "text": "%s km" % round(distance / 1000, 1),
+                        "value": int(round(distance)),
+                    },
+                    "duration": {
+                        "text": "%s mins" % int(round(duration / 60)),
+                        "value": int(round(duration)),
+                    },
+                    "status": "OK",
+                }
+                for distance, duration in zip(distance_row, duration_row)
+            ]
+            rows.append({"elements": elements})
+        return {
+            "destination_addresses": ["%s,%s" % latlng for latlng in destinations],
+            "origin_addresses": ["%s,%s" % latlng for latlng in origins],
+            "rows": rows,
+            "status": "OK",
+        }
+
+
+def parse_latlng(value):
+    lat, lng = value.split(",")
+    return float(lat), float(lng)
+
+
+class MockGMapsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server = self.server
+        behavior = server.behavior
+        server.count("requests")
+        time.sleep(max(0, behavior.latency.sample(behavior.rng)))
+        draw = behavior.rng.random()
+        if draw < behavior.error_rate:
+            server.count("errors")
+            self.send_json(500, {"status": "UNKNOWN_ERROR"})
+            return
+        if draw < behavior.error_rate + behavior.over_query_limit_rate:
+            server.count("over_query_limit")
+            self.send_json(
+                200,
+                {
+                    "status": "OVER_QUERY_LIMIT",
+                    "error_message": "You have exceeded your rate-limit for this API.",
+                },
+            )
+            return
+        if url.path == PLACES_PATH:
+            self.send_json(200, behavior.places_response(params))
+        elif url.path == DISTANCE_MATRIX_PATH:
+            self.send_json(200, behavior.distance_matrix_response(params))
+        else:
+            self.send_json(404, {"status": "NOT_FOUND"})
+
+    def send_json(self, status_code, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class MockGMapsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, behavior):
+        """Initialization.
+        @param address: (host, port), port 0 picks a free port
+        @param behavior: MockBehavior, may be swapped between runs
+
+        """
+        super().__init__(address, MockGMapsHandler)
+        self.behavior = behavior
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def reset(self, behavior=None):
+        with self.lock:
+            self.counters = {}
+        if behavior is not None:
+            self.behavior = behavior
+
+
+def load_places(places_file):
+    """Canned Places API results, e.g. the raw output of places_api_worker."""
+    if not places_file:
+        return []
+    with open(places_file, encoding="utf-8") as f:
+        return [place for place in json.load(f) if place.get("geometry")]
+
+
+def main(config_file):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    server_conf = conf.get("server")
+    places = load_places(server_conf.get("places_file"))
+    logging.info("%s canned places loaded", len(places))
+    behavior = MockBehavior.from_conf(conf.get("scenarios")[0], places)
+    server = MockGMapsServer(
+        (server_conf.get("host", "127.0.0.1"), int(server_conf.get("port", 0))),
+        behavior,
+    )
+    logging.info("Mock Google Maps server listening on %s", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Requests served: %s", server.counters)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
@@ -1,7 +1,17 @@
+import argparse
+import logging
+import logging.config
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import shapefile as shp
+import yaml
+from addict import Dict as Addict
 from area import area
+from geometry import pack_polygons, polygon_areas, polygon_centroids
+from metrics import Metrics
 
 
 def read_shapefile(sf):
@@ -52,48 +62,114 @@ def calc_floor_area(coords):
     return area(obj)
 
 
-def is_penang(geocode):
-    """Check whether a building is within Penang based on its geocode
+def in_region(lng, lat, region):
+    """Check which geocodes fall strictly inside the bounding box of a region
     """
-    lat, lng = geocode[1], geocode[0]
-    if lat > 5.1175 and lat < 5.5929 and lng > 100.1691 and lng < 100.5569:
-        return True
-    else:
-        return False
+    return (lat > region["min_lat"]) & (lat < region["max_lat"]) & \
+        (lng > region["min_lng"]) & (lng < region["max_lng"])
+
+
+def measure_buildings(coords_list):
+    """Compute geometric center and floor area of a chunk of buildings,
+    run in a worker process
+    """
+    points, offsets = pack_polygons(coords_list)
+    return polygon_centroids(points, offsets), polygon_areas(points, offsets)
 
 
-def main():
-    # print(Path.cwd().parent)
-    shp_path = 'raw/gis_osm_buildings_a_free_1.shp'
+def iter_building_chunks(sf, residential_types, region, chunk_size):
+    """Stream the residential buildings overlapping the region in chunks.
+    Buildings of other types are rejected on their attributes before their
+    shape is read, and shapes outside the bounding box on their header
+    alone, before their points are parsed.
+    """
+    bbox = (region["min_lng"], region["min_lat"],
+            region["max_lng"], region["max_lat"])
+    residential_types = set(residential_types)
+    records, coords_list = [], []
+    for oid, record in enumerate(sf.iterRecords(fields=["name", "type"])):
+        if record["type"] not in residential_types:
+            continue
+        shape = sf.shape(oid, bbox=bbox)
+        if shape is None or not shape.points:
+            continue
+        records.append((record["name"], record["type"]))
+        coords_list.append(shape.points)
+        if len(records) >= chunk_size:
+            yield records, coords_list
+            records, coords_list = [], []
+    if records:
+        yield records, coords_list
+
+
+def extract_buildings(sf, residential_types, region, chunk_size, workers):
+    """Yield DataFrames of the residential buildings whose center is inside
+    the region, with geometric center and floor area computed across a
+    pool of worker processes. Only a bounded number of chunks is in flight.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        chunks = iter_building_chunks(sf, residential_types, region, chunk_size)
+        while True:
+            for records, coords_list in chunks:
+                pending.append(
+                    (records, pool.submit(measure_buildings, coords_list)))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                return
+            records, future = pending.popleft()
+            centers, areas = future.result()
+            df = pd.DataFrame(records, columns=["name", "type"])
+            df["area"] = areas
+            df["center_lng"] = centers[:, 0]
+            df["center_lat"] = centers[:, 1]
+            yield df.loc[in_region(df["center_lng"], df["center_lat"], region)]
+
+
+def main(config_file, profile=False):
+    conf = Addict(yaml.safe_load(open(config_file, 'r')))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(level=logging.INFO,
+                            format="%(asctime)s - %(levelname)s - %(message)s")
+    metrics = Metrics.from_conf(conf.get("metrics"), "osm_preprocessor", profile)
+    metrics.start_stage("extract_buildings")
+    shp_path = conf.get("input").get("building_shape_file")
     sf = shp.Reader(shp_path)
-    print("type of sf: ", type(sf))
-    # print("shape of sf: ", sf.shapes())
-    shp_df = read_shapefile(sf)
-    print("Building types: ", shp_df['type'].unique())
-    print(shp_df.head())
-    residential_types = ["condominium", "apartment", "apartments",
-                         "dormitory", "EiS_Residences", "residential",
-                         "bungalow", "detached", "mix_used"]
-    residential_df = shp_df.loc[shp_df["type"].isin(residential_types)]
-    residential_df = residential_df.set_index("osm_id")
-    residential_df["center"] = residential_df["coords"].apply(lambda coords: get_center(coords))
-
-    # Boundary of Penang State, obtained from OpenStreetMap
-    # lat: 5.1175 - 5.5929; lng: 100.1691 - 100.5569
-    residential_df["is_penang"] = residential_df["center"].apply(lambda geocode: is_penang(geocode))
-    penang_df = residential_df.loc[residential_df["is_penang"] == True]
-    penang_df["area"] = penang_df["coords"].apply(lambda coords: calc_floor_area(coords))
-    penang_df["center_lng"] = penang_df["center"].apply(lambda geocode: geocode[0])
-    penang_df["center_lat"] = penang_df["center"].apply(lambda geocode: geocode[1])
-    penang_df["area"] = penang_df["coords"].apply(lambda coords: calc_floor_area(coords))
-    penang_df["id"] = np.arange(len(penang_df))
-    penang_df = penang_df.reset_index()
-    penang_df = penang_df.drop(["osm_id", "code", "fclass",
-                                "is_penang", "center", "coords"], axis=1)
-    penang_df = penang_df.set_index('id')
-    print(penang_df.head())
-    penang_df.to_csv("data/penang_residential_buildings.csv", index=True)
+    logging.info("%s buildings in %s", len(sf), shp_path)
+    residential_types = conf.get("input").get("residential_types")
+    region = conf.get("region")
+    output_fp = conf.get("output").get("residential_buildings_file")
+    num_buildings = 0
+    for buildings_df in extract_buildings(sf, residential_types, region,
+                                          int(conf.get("chunk_size", 10000)),
+                                          int(conf.get("workers", 1))):
+        buildings_df.index = np.arange(num_buildings,
+                                       num_buildings + len(buildings_df))
+        buildings_df.index.name = "id"
+        buildings_df.to_csv(output_fp, mode="a" if num_buildings else "w",
+                            header=not num_buildings, index=True)
+        num_buildings += len(buildings_df)
+        metrics.count("buildings_extracted", len(buildings_df))
+        logging.info("%s residential buildings extracted ... "
+                     "Elapsed time %s seconds",
+                     num_buildings, metrics.elapsed())
+    logging.info("%s residential buildings written to %s",
+                 num_buildings, output_fp)
+    metrics.write()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", required=True,
+                        help="directory of the config file")
+    parser.add_argument("--profile", action="store_true",
+                        help="record cProfile stats and peak memory of every stage")
+    args = parser.parse_args()
+    try:
+        main(args.config, profile=args.profile)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
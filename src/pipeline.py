@@ -0,0 +1,418 @@
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import yaml
+from addict import Dict as Addict
+
+SHAPEFILE_SIDECARS = (".shx", ".dbf", ".prj", ".cpg")
+IGNORED_CONFIG_KEYS = ("logging", "metrics")
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def lookup(conf, key):
+    """Value of a dotted key, e.g. output.grid_population_file."""
+    value = conf
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def artifact_files(path):
+    """Files making up an artifact: a shapefile comes with its sidecars."""
+    root, extension = os.path.splitext(path)
+    if extension.lower() != ".shp":
+        return [path]
+    return [path] + [
+        root + sidecar
+        for sidecar in SHAPEFILE_SIDECARS
+        if os.path.exists(root + sidecar)
+    ]
+
+
+def local_modules(script, src_dir, seen=None):
+    """The script and every module of src_dir it imports, recursively."""
+    seen = set() if seen is None else seen
+    if script in seen:
+        return seen
+    seen.add(script)
+    with open(script, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), script)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = os.path.join(src_dir, name.split(".")[0] + ".py")
+            if os.path.exists(module):
+                local_modules(module, src_dir, seen)
+    return seen
+
+
+class FileHasher:
+    def __init__(self, known=None):
+        """Initialization.
+        @param known: {path: [size, mtime_ns, digest]} of earlier runs, so
+            that unchanged files are not read again
+
+        """
+        self.known = dict(known or {})
+
+    def digest(self, path):
+        """Content hash of a file, or None if it does not exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        known = self.known.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        self.known[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def artifact_digest(self, path):
+        digests = [self.digest(file) for file in artifact_files(path)]
+        if None in digests:
+            return None
+        if len(digests) == 1:
+            return digests[0]
+        return hashlib.sha256("".join(digests).encode("utf-8")).hexdigest()
+
+
+class Stage:
+    def __init__(self, name, script, config_file, inputs, outputs, config_keys, args):
+        """Initialization.
+        @param name
+        @param script: path of the script, run as a subprocess
+        @param config_file: config of the script
+        @param inputs, outputs: dotted keys of files in the config; an
+            input given as {key, when} is only read while the dotted key
+            when is set in the config
+        @param config_keys: dotted keys of the config the outputs depend
+            on, the whole config but logging and metrics if empty
+        @param args: extra command line arguments of the script
+
+        """
+        self.name = name
+        self.script = script
+        self.config_file = config_file
+        with open(config_file, "r") as f:
+            self.conf = yaml.safe_load(f)
+        self.inputs = [
+            self.resolve(key) if isinstance(key, str) else self.resolve(key["key"])
+            for key in inputs
+            if isinstance(key, str) or lookup(self.conf, key["when"])
+        ]
+        self.outputs = [self.resolve(key) for key in outputs]
+        self.config_keys = list(config_keys)
+        self.args = list(args)
+
+    @classmethod
+    def from_conf(cls, name, conf):
+        return cls(
+            name,
+            conf.get("script"),
+            conf.get("config"),
+            conf.get("inputs") or [],
+            conf.get("outputs") or [],
+            conf.get("config_keys") or [],
+            conf.get("args") or [],
+        )
+
+    def resolve(self, key):
+        path = lookup(self.conf, key)
+        if not path:
+            raise ValueError(
+                "%s: no file under %s in %s" % (self.name, key, self.config_file)
+            )
+        return path
+
+    def config_digest(self):
+        if self.config_keys:
+            selected = {key: lookup(self.conf, key) for key in self.config_keys}
+        else:
+            selected = {
+                key: value
+                for key, value in self.conf.items()
+                if key not in IGNORED_CONFIG_KEYS
+            }
+        return hashlib.sha256(
+            json.dumps(selected, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def fingerprint(self, hasher):
+        """Hash of the input contents, the relevant config and the code of
+        the script and its local imports. None while an input is missing.
+        """
+        parts = {"config": self.config_digest(), "inputs": {}, "code": {}}
+        for path in self.inputs:
+            digest = hasher.artifact_digest(path)
+            if digest is None:
+                return None
+            parts["inputs"][path] = digest
+        src_dir = os.path.dirname(os.path.abspath(self.script))
+        for module in sorted(local_modules(os.path.abspath(self.script), src_dir)):
+            parts["code"][os.path.relpath(module, src_dir)] = hasher.digest(module)
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def command(self):
+        return [sys.executable, self.script, "-c", self.config_file] + self.args
+
+
+def dependencies(stages):
+    """Stages producing the inputs of each stage."""
+    producers = {}
+    for stage in stages.values():
+        for path in stage.outputs:
+            producers[os.path.normpath(path)] = stage.name
+    return {
+        stage.name: {
+            producers[os.path.normpath(path)]
+            for path in stage.inputs
+            if os.path.normpath(path) in producers
+            and producers[os.path.normpath(path)] != stage.name
+        }
+        for stage in stages.values()
+    }
+
+
+def topological_order(depends_on):
+    """Stage names with every stage after the stages it depends on."""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError("Cyclic dependency through %s" % name)
+        visiting.add(name)
+        for dep in sorted(depends_on[name]):
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in sorted(depends_on):
+        visit(name)
+    return order
+
+
+def upstream(targets, depends_on):
+    """The targets and every stage they depend on."""
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(depends_on[name])
+    return selected
+
+
+class PipelineRunner:
+    def __init__(self, stages, state_file, workers=2, force=False, dry_run=False):
+        """Initialization.
+        @param stages: {name: Stage}
+        @param state_file: JSON file of the fingerprints and output hashes
+            of the last successful run of each stage
+        @param workers: stages run at the same time
+        @param force: run the stages even when up to date
+        @param dry_run: only report the stages that would run
+
+        """
+        self.stages = stages
+        self.depends_on = dependencies(stages)
+        self.produced = {
+            os.path.normpath(path)
+            for stage in stages.values()
+            for path in stage.outputs
+        }
+        self.order = topological_order(self.depends_on)
+        self.state_file = state_file
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(state_file):
+            with open(state_file, encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.hasher = FileHasher(self.state.get("files"))
+        self.workers = max(1, int(workers))
+        self.force = force
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+
+    def is_up_to_date(self, stage, fingerprint):
+        recorded = self.state["stages"].get(stage.name)
+        if self.force or recorded is None or recorded["fingerprint"] != fingerprint:
+            return False
+        return all(
+            self.hasher.artifact_digest(path) == recorded["outputs"].get(path)
+            for path in stage.outputs
+        )
+
+    def run_stage(self, stage):
+        """Run a stage unless it is up to date. Returns "ran", "skipped" or
+        "would run" on a dry run. A stage missing source inputs, which no
+        stage produces, is taken as up to date while its outputs exist.
+        """
+        fingerprint = stage.fingerprint(self.hasher)
+        if fingerprint is None:
+            missing = [
+                p for p in stage.inputs if self.hasher.artifact_digest(p) is None
+            ]
+            if not any(os.path.normpath(p) in self.produced for p in missing) and all(
+                self.hasher.artifact_digest(p) is not None for p in stage.outputs
+            ):
+                logging.warning(
+                    "%s: source inputs %s missing, existing outputs kept",
+                    stage.name,
+                    missing,
+                )
+                return "skipped"
+            if self.dry_run:
+                logging.info("%s would run once %s exist", stage.name, missing)
+                return "would run"
+            raise FileNotFoundError("%s: missing inputs %s" % (stage.name, missing))
+        if self.is_up_to_date(stage, fingerprint):
+            logging.info("%s is up to date", stage.name)
+            return "skipped"
+        if self.dry_run:
+            logging.info("%s would run: %s", stage.name, " ".join(stage.command()))
+            return "would run"
+        logging.info("Running %s: %s", stage.name, " ".join(stage.command()))
+        start_time = time.time()
+        subprocess.run(stage.command(), check=True)
+        outputs = {path: self.hasher.artifact_digest(path) for path in stage.outputs}
+        with self.lock:
+            self.state["stages"][stage.name] = {
+                "fingerprint": fingerprint,
+                "outputs": outputs,
+                "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+        logging.info(
+            "%s done ... Elapsed time %s seconds",
+            stage.name,
+            round(time.time() - start_time, 4),
+        )
+        return "ran"
+
+    def run(self, targets=None):
+        """Run the targets and the stages they depend on, every stage as soon
+        as its dependencies are done. Returns the status of every stage.
+        """
+        selected = upstream(targets or list(self.stages), self.depends_on)
+        status = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while len(status) < len(selected):
+                for name in self.order:
+                    if name not in selected or name in status:
+                        continue
+                    if name in running.values():
+                        continue
+                    needed = self.depends_on[name]
+                    if any(status.get(dep) in ("failed", "blocked") for dep in needed):
+                        status[name] = "blocked"
+                        logging.warning("%s blocked by a failed dependency", name)
+                    elif self.dry_run and any(
+                        status.get(dep) == "would run" for dep in needed
+                    ):
+                        status[name] = "would run"
+                        logging.info("%s would run after %s", name, sorted(needed))
+                    elif all(dep in status for dep in needed):
+                        running[pool.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception:
+                        logging.exception("%s failed", name)
+                        status[name] = "failed"
+                    self.save_state()
+        return status
+
+    def save_state(self):
+        if self.dry_run:
+            return
+        if os.path.dirname(self.state_file):
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with self.lock:
+            self.state["files"] = dict(self.hasher.known)
+            state = json.dumps(self.state, indent=2, sort_keys=True)
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(state)
+        os.replace(tmp_file, self.state_file)
+
+
+def main(config_file, targets=None, force=False, dry_run=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    stages = {
+        name: Stage.from_conf(name, stage_conf)
+        for name, stage_conf in conf.get("stages").items()
+    }
+    unknown = set(targets or []) - set(stages)
+    if unknown:
+        raise ValueError("Unknown stages: %s" % sorted(unknown))
+    runner = PipelineRunner(
+        stages,
+        conf.get("state_file", "cache/pipeline_state.json"),
+        workers=conf.get("workers", 2),
+        force=force,
+        dry_run=dry_run,
+    )
+    status = runner.run(targets)
+    for name in runner.order:
+        if name in status:
+            logging.info("%s: %s", name, status[name])
+    if any(stage_status in ("failed", "blocked") for stage_status in status.values()):
+        raise RuntimeError("Pipeline failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "stages", nargs="*", help="stages to bring up to date, all by default"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="run the stages even if up to date"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report the stages that would run"
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, args.stages, force=args.force, dry_run=args.dry_run)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
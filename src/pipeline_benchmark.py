@@ -0,0 +1,324 @@
+import argparse
+import importlib
+import json
+import logging
+import logging.config
+import os
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import yaml
+from addict import Dict as Addict
+
+from artifacts import write_layer, write_table
+from synthetic_city import (
+    grid_bounds,
+    grid_layer,
+    make_buildings,
+    make_grid_lattice,
+    make_places,
+    write_building_shapefile,
+    write_distance_responses,
+)
+
+STAGES = [
+    "osm_preprocessor",
+    "grid_population_layer_builder",
+    "places_api_parser",
+    "distance_api_parser",
+]
+
+
+def git_commit():
+    """Short hash of the checked out commit, marked dirty with local changes."""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        )
+        status = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    commit = commit.decode("utf-8").strip()
+    return commit + "-dirty" if status.strip() else commit
+
+
+def generate_inputs(size, work_dir, seed):
+    """Write the synthetic inputs of every stage for one size, and return
+    their paths and the number of items each stage processes.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(work_dir, exist_ok=True)
+    num_districts = int(size.get("districts", 5))
+    grid_df = make_grid_lattice(
+        int(size.get("grid_rows")),
+        int(size.get("grid_cols")),
+        num_districts=num_districts,
+    )
+    bounds = grid_bounds(grid_df)
+    num_buildings = int(size.get("buildings"))
+    num_stores = int(size.get("stores"))
+    paths = {
+        "grid_file": os.path.join(work_dir, "grid.csv"),
+        "grid_shape_file": os.path.join(work_dir, "grid.geo.parquet"),
+        "building_shape_file": os.path.join(work_dir, "buildings.shp"),
+        "residential_buildings_file": os.path.join(
+            work_dir, "residential_buildings.csv"
+        ),
+        "grid_population_file": os.path.join(work_dir, "grid_population.parquet"),
+        "places_raw": os.path.join(work_dir, "places_raw.json"),
+        "distance_raw": os.path.join(work_dir, "grid_to_supermarket_dist.jsonl"),
+    }
+    grid_df.to_csv(paths["grid_file"], index=False)
+    write_layer(grid_layer(grid_df), paths["grid_shape_file"])
+    write_building_shapefile(paths["building_shape_file"], num_buildings, bounds, rng)
+    make_buildings(num_buildings, bounds, rng).to_csv(
+        paths["residential_buildings_file"], index=False
+    )
+    write_table(
+        pd.DataFrame(
+            {
+                "id": grid_df["id"].values,
+                "population": rng.randint(0, 20000, len(grid_df)),
+            }
+        ),
+        paths["grid_population_file"],
+    )
+    places = make_places(num_stores, bounds, rng)
+    with open(paths["places_raw"], "w", encoding="utf-8") as f:
+        json.dump(places, f)
+    write_distance_responses(
+        paths["distance_raw"], grid_df["id"].values, np.arange(num_stores), rng
+    )
+    items = {
+        "osm_preprocessor": num_buildings,
+        "grid_population_layer_builder": num_buildings,
+        "places_api_parser": len(places),
+        "distance_api_parser": len(grid_df) * num_stores,
+    }
+    return paths, items, num_districts, bounds
+
+
+def stage_configs(paths, work_dir, num_districts, bounds, conf):
+    """Config of each stage, reading the synthetic inputs and writing its
+    outputs to work_dir.
+    """
+    min_lng, min_lat, max_lng, max_lat = bounds
+    return {
+        "osm_preprocessor": {
+            "input": {
+                "building_shape_file": paths["building_shape_file"],
+                "residential_types": [
+                    "apartments",
+                    "residential",
+                    "bungalow",
+                    "detached",
+                ],
+            },
+            "region": {
+                "min_lat": min_lat,
+                "max_lat": max_lat,
+                "min_lng": min_lng,
+                "max_lng": max_lng,
+            },
+            "chunk_size": conf.get("chunk_size", 10000),
+            "workers": conf.get("workers", 1),
+            "output": {
+                "residential_buildings_file": os.path.join(
+                    work_dir, "extracted_buildings.csv"
+                )
+            },
+        },
+        "grid_population_layer_builder": {
+            "input": {
+                "grid_file": paths["grid_file"],
+                "residential_buildings_file": paths["residential_buildings_file"],
+                "grid_shape_file": paths["grid_shape_file"],
+            },
+            "district_population": [200000] * num_districts,
+            "output": {
+                "grid_geocode_file": os.path.join(work_dir, "grid_center_geocode.csv"),
+                "grid_population_file": os.path.join(
+                    work_dir, "built_grid_population.parquet"
+                ),
+                "grid_population_shape_file": os.path.join(
+                    work_dir, "built_grid_population.geo.parquet"
+                ),
+            },
+        },
+        "places_api_parser": {
+            "output": {
+                "existing_supermarkets_raw": paths["places_raw"],
+                "existing_supermarkets_data": os.path.join(work_dir, "suppliers.csv"),
+            }
+        },
+        "distance_api_parser": {
+            "max_driving_time": 1200,
+            "parse_chunk_size": conf.get("parse_chunk_size", 100000),
+            "input": {
+                "grid_population_file": paths["grid_population_file"],
+                "grid_shape_file": paths["grid_shape_file"],
+            },
+            "output": {
+                "grid_to_supermarket_dist_raw": paths["distance_raw"],
+                "grid_to_supermarket_dist_data": os.path.join(
+                    work_dir, "grid_to_supermarket_dist.parquet"
+                ),
+                "supermarket_density_file": os.path.join(
+                    work_dir, "supermarket_density.parquet"
+                ),
+                "supermarket_density_shape_file": os.path.join(
+                    work_dir, "supermarket_density.geo.parquet"
+                ),
+            },
+        },
+    }
+
+
+def profile_stage(stage, config_file):
+    """Run the main of a stage, returning its elapsed time and the peak of
+    memory allocated by Python in this process. Memory of worker processes,
+    e.g. those of osm_preprocessor, is not traced.
+    """
+    stage_main = importlib.import_module(stage).main
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        stage_main(config_file)
+        elapsed_time = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed_time, peak
+
+
+def run_benchmark(conf, commit):
+    """Time and memory-profile every stage across the configured sizes,
+    and yield one result per run.
+    """
+    stages = conf.get("stages") or STAGES
+    work_root = conf.get("work_dir", "cache/benchmark")
+    for size in conf.get("sizes"):
+        work_dir = os.path.join(work_root, size.get("name"))
+        logging.info(
+            "Generating synthetic city of size %s in %s", size.get("name"), work_dir
+        )
+        paths, items, num_districts, bounds = generate_inputs(
+            size, work_dir, conf.get("seed", 0)
+        )
+        configs = stage_configs(paths, work_dir, num_districts, bounds, conf)
+        for stage in stages:
+            config_file = os.path.join(work_dir, "%s.yml" % stage)
+            with open(config_file, "w") as f:
+                yaml.safe_dump(configs[stage], f)
+            for repeat in range(int(conf.get("repeat", 1))):
+                result = {
+                    "commit": commit,
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "size": size.get("name"),
+                    "stage": stage,
+                    "repeat": repeat,
+                    "items": items[stage],
+                }
+                try:
+                    elapsed_time, peak = profile_stage(stage, config_file)
+                except Exception as exc:
+                    logging.exception("%s failed on size %s", stage, size.get("name"))
+                    result.update({"status": "failed", "error": repr(exc)})
+                else:
+                    result.update(
+                        {
+                            "status": "ok",
+                            "elapsed_time": round(elapsed_time, 4),
+                            "peak_memory_mb": round(peak / 2**20, 2),
+                            "throughput": round(items[stage] / elapsed_time, 2),
+                        }
+                    )
+                    logging.info(
+                        "%s on size %s: %s seconds, peak memory %s MB",
+                        stage,
+                        size.get("name"),
+                        result["elapsed_time"],
+                        result["peak_memory_mb"],
+                    )
+                yield result
+
+
+def compare_results(results_fp, threshold):
+    """Compare the median elapsed time and peak memory of every stage and
+    size between the last two commits benchmarked, and return the rows
+    slower than threshold times the previous commit.
+    """
+    df = pd.read_json(results_fp, lines=True)
+    df = df.loc[df["status"] == "ok"]
+    commits = list(pd.unique(df["commit"]))
+    if len(commits) < 2:
+        logging.info("Nothing to compare, %s commit(s) benchmarked", len(commits))
+        return pd.DataFrame()
+    previous, current = commits[-2], commits[-1]
+    medians = (
+        df.loc[df["commit"].isin([previous, current])]
+        .groupby(["size", "stage", "commit"])[["elapsed_time", "peak_memory_mb"]]
+        .median()
+        .unstack("commit")
+    )
+    medians["time_ratio"] = (
+        medians[("elapsed_time", current)] / medians[("elapsed_time", previous)]
+    )
+    medians["memory_ratio"] = (
+        medians[("peak_memory_mb", current)] / medians[("peak_memory_mb", previous)]
+    )
+    logging.info("Benchmark of %s against %s:\n%s", current, previous, medians)
+    return medians.loc[medians["time_ratio"] > threshold]
+
+
+def main(config_file, compare=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    results_fp = conf.get("output").get("benchmark_file")
+    threshold = float(conf.get("regression_threshold", 1.2))
+    if not compare:
+        commit = git_commit()
+        logging.info("Benchmarking pipeline stages at commit %s", commit)
+        if os.path.dirname(results_fp):
+            os.makedirs(os.path.dirname(results_fp), exist_ok=True)
+        for result in run_benchmark(conf, commit):
+            with open(results_fp, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result) + "\n")
+        logging.info("Benchmark results appended to %s", results_fp)
+    regressions = compare_results(results_fp, threshold)
+    if len(regressions):
+        logging.warning(
+            "%s stage(s) more than %s times slower than the previous commit:\n%s",
+            len(regressions),
+            threshold,
+            regressions,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="only compare the results already stored for the last two commits",
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, compare=args.compare)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
@@ -5,15 +5,19 @@ import yaml
 import json
 import pandas as pd
 from addict import Dict as Addict
+from metrics import Metrics
+from store_dedup import deduplicate
 
 
-def main(config_file):
+def main(config_file, profile=False):
     conf = Addict(yaml.safe_load(open(config_file, 'r')))
     if conf.get("logging") is not None:
         logging.config.dictConfig(conf["logging"])
     else:
         logging.basicConfig(level=logging.INFO,
                             format="%(asctime)s - %(levelname)s - %(message)s")
+    metrics = Metrics.from_conf(conf.get("metrics"), "places_api_parser", profile)
+    metrics.start_stage("parse_places")
     raw_file = conf.get("output").get("existing_supermarkets_raw")
     supermarkets = []
     with open(raw_file, encoding='utf-8') as f:
@@ -25,28 +29,40 @@ def main(config_file):
             supermarket_obj["lat"] = geocode.get("lat")
             supermarket_obj["lng"] = geocode.get("lng")
             supermarket_obj["type"] = supermarket_raw.get("place_type")
+            supermarket_obj["place_id"] = supermarket_raw.get("place_id")
             supermarkets.append(supermarket_obj)
+    metrics.count("rows_parsed", len(supermarkets))
     
+    metrics.start_stage("deduplicate")
     supermarkets_df = pd.DataFrame(supermarkets)
     logging.info("%s supermarkets are located in the city", supermarkets_df.shape[0])
-    supermarkets_df = supermarkets_df.drop_duplicates(subset=["lat", "lng"])
+    dedup_conf = conf.get("dedup", {})
+    supermarkets_df = deduplicate(supermarkets_df,
+                                  float(dedup_conf.get("max_distance", 50)),
+                                  float(dedup_conf.get("min_similarity", 0.8)),
+                                  dedup_conf.get("type_priority"))
+    metrics.count("duplicates_merged", len(supermarkets) - supermarkets_df.shape[0])
     logging.info("There are %s supermarkets left after duplicates removed", supermarkets_df.shape[0])
     grocery_df = supermarkets_df.loc[supermarkets_df["type"] == "grocery"]
     logging.info("%s of the results are grocery", grocery_df.shape[0])
     supermarkets_df = supermarkets_df.reset_index()
     supermarkets_df = supermarkets_df.loc[supermarkets_df["type"] == "supermarket"] 
+    metrics.gauge("supermarkets", supermarkets_df.shape[0])
     output_fp = conf.get("output").get("existing_supermarkets_data")
     supermarkets_df.to_csv(output_fp, index=False)
     logging.info("Information of existing supermarkets written to %s", output_fp)
+    metrics.write()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", required=True,
                         help="directory of the config file")
+    parser.add_argument("--profile", action="store_true",
+                        help="record cProfile stats and peak memory of every stage")
     args = parser.parse_args()
     try:
-        main(args.config)
+        main(args.config, profile=args.profile)
     except:
         logging.exception("Unhandled error during processing")
         raise
\ No newline at end of file
@@ -5,9 +5,17 @@ import logging
 import logging.config
 import time
 
-import googlemaps
+import numpy as np
 import yaml
 from addict import Dict as Addict
+from googlemaps.exceptions import ApiError
+
+from api_executor import ConcurrentExecutor, make_client
+from metrics import Metrics
+from response_cache import CachedClient, ResponseCache
+from spatial_prefilter import haversine
+
+KM_PER_DEGREE = 111.32  # Length of a degree of latitude in km
 
 
 class PlacesAPIWorker:
@@ -32,6 +40,192 @@ class PlacesAPIWorker:
         return None
 
 
+class Cell:
+    def __init__(self, min_lat, min_lng, max_lat, max_lng, depth=0):
+        """Initialization.
+        @param min_lat, min_lng, max_lat, max_lng: bounds of the cell
+        @param depth: number of subdivisions from the coarse cell
+
+        """
+        self.min_lat = min_lat
+        self.min_lng = min_lng
+        self.max_lat = max_lat
+        self.max_lng = max_lng
+        self.depth = depth
+
+    @property
+    def center(self):
+        return (self.min_lat + self.max_lat) / 2, (self.min_lng + self.max_lng) / 2
+
+    @property
+    def radius(self):
+        """Radius in meter of the circle through the corners of the cell."""
+        lat, lng = self.center
+        return float(haversine(lat, lng, self.max_lat, self.max_lng))
+
+    def split(self):
+        lat, lng = self.center
+        return [
+            Cell(min_lat, min_lng, max_lat, max_lng, self.depth + 1)
+            for min_lat, max_lat in ((self.min_lat, lat), (lat, self.max_lat))
+            for min_lng, max_lng in ((self.min_lng, lng), (lng, self.max_lng))
+        ]
+
+    def contains_any(self, lat, lng, margin=0.0):
+        """Whether any of the points is within margin degrees of the cell."""
+        return bool(
+            np.any(
+                (lat >= self.min_lat - margin)
+                & (lat <= self.max_lat + margin)
+                & (lng >= self.min_lng - margin)
+                & (lng <= self.max_lng + margin)
+            )
+        )
+
+
+def cover_cells(grids, cell_size, margin):
+    """Square cells of cell_size km covering the grid centers, keeping only
+    the cells within margin degrees of a grid center.
+    """
+    lat = np.array([float(grid["center_lat"]) for grid in grids])
+    lng = np.array([float(grid["center_lng"]) for grid in grids])
+    step_lat = cell_size / KM_PER_DEGREE
+    step_lng = cell_size / (KM_PER_DEGREE * np.cos(np.deg2rad(lat.mean())))
+    cells = []
+    for min_lat in np.arange(lat.min() - margin, lat.max() + margin, step_lat):
+        for min_lng in np.arange(lng.min() - margin, lng.max() + margin, step_lng):
+            cell = Cell(min_lat, min_lng, min_lat + step_lat, min_lng + step_lng)
+            if cell.contains_any(lat, lng, margin):
+                cells.append(cell)
+    return cells, (lat, lng)
+
+
+class CellSearchWorker:
+    def __init__(
+        self, gmaps, cell, query, max_pages, result_cap, page_delay, executor=None
+    ):
+        """Initialization.
+        @param gmaps
+        @param cell: Cell searched with the circle through its corners
+        @param query
+        @param max_pages: pages of results followed through next_page_token
+        @param result_cap: results of a saturated search, i.e. the most the
+            API returns over max_pages
+        @param page_delay: seconds before a next_page_token becomes valid
+        @param executor: ConcurrentExecutor rate limiting and retrying every
+            page request, if given
+
+        """
+        self.gmaps = gmaps
+        self.executor = executor
+        self.cell = cell
+        self.query = query
+        self.max_pages = int(max_pages)
+        self.result_cap = int(result_cap)
+        self.page_delay = float(page_delay)
+        self.requests = 0
+
+    def run(self):
+        """Return the results of all pages and whether the search was
+        saturated, in which case the cell needs subdividing.
+        """
+        lat, lng = self.cell.center
+        location = "%s,%s" % (lat, lng)
+        radius = int(self.cell.radius)
+        response = self.fetch(location, radius)
+        results = list(response.get("results") or [])
+        pages = 1
+        while response.get("next_page_token") and pages < self.max_pages:
+            response = self.next_page(location, radius, response["next_page_token"])
+            results.extend(response.get("results") or [])
+            pages += 1
+        saturated = len(results) >= self.result_cap or bool(
+            response.get("next_page_token")
+        )
+        return results, saturated
+
+    def fetch(self, location, radius, page_token=None):
+        """One page of the search, through the executor if any, so that a
+        failed page is retried alone.
+        """
+        if self.executor is None:
+            return self.places(location, radius, page_token)
+        return self.executor.call(self.places, location, radius, page_token)
+
+    def places(self, location, radius, page_token):
+        self.requests += 1
+        return self.gmaps.places(
+            self.query, location=location, radius=radius, page_token=page_token
+        )
+
+    def next_page(self, location, radius, page_token):
+        for attempt in range(3):
+            time.sleep(self.page_delay)
+            try:
+                return self.fetch(location, radius, page_token)
+            except ApiError as exc:
+                # The token is not valid until a short time after it is issued
+                if exc.status != "INVALID_REQUEST" or attempt == 2:
+                    raise
+        return {}
+
+
+def quadtree_search(executor, gmaps, cells, points, query, search_conf):
+    """Search the cells level by level, subdividing the saturated ones, and
+    yield the worker and results of every search.
+    """
+    max_depth = int(search_conf.get("max_depth", 4))
+    margin = float(search_conf.get("margin", 0.005))
+    level = cells
+    while level:
+        num_saturated = 0
+        workers = [
+            CellSearchWorker(
+                gmaps,
+                cell,
+                query,
+                search_conf.get("max_pages", 3),
+                search_conf.get("result_cap", 60),
+                search_conf.get("page_delay", 2),
+                executor,
+            )
+            for cell in level
+        ]
+        level = []
+        # Every page takes its own token of the executor
+        for worker, (results, saturated) in executor.map(
+            lambda worker: (worker, worker.run()), workers, limited=False
+        ):
+            yield worker, results
+            if saturated and worker.cell.depth < max_depth:
+                num_saturated += 1
+                level.extend(
+                    cell
+                    for cell in worker.cell.split()
+                    if cell.contains_any(points[0], points[1], margin)
+                )
+        if level:
+            logging.info(
+                "%s saturated searches of %s, subdividing into %s cells",
+                num_saturated,
+                query,
+                len(level),
+            )
+
+
+def add_places(results, query, place_ids, locations):
+    """Append the results not seen yet to locations, tagged with the query."""
+    added = 0
+    for result in results or []:
+        place_id = result.get("place_id")
+        if place_id and place_id not in place_ids:
+            place_ids.add(place_id)
+            result["place_type"] = query
+            locations.append(result)
+            added += 1
+    return added
+
+
 def load_grids(file):
     grids_file_reader = csv.reader(open(file))
     grids_file_header = next(grids_file_reader)
@@ -42,7 +236,7 @@ def load_grids(file):
     return grids
 
 
-def main(config_file):
+def main(config_file, profile=False):
     conf = Addict(yaml.safe_load(open(config_file, "r")))
     if conf.get("logging") is not None:
         logging.config.dictConfig(conf["logging"])
@@ -50,9 +244,16 @@ def main(config_file):
         logging.basicConfig(
             level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
         )
+    metrics = Metrics.from_conf(conf.get("metrics"), "places_api_worker", profile)
+    metrics.start_stage("load_inputs")
     logging.info("Initialize Google Maps service ")
+    executor = ConcurrentExecutor.from_conf(conf.get("executor"), metrics)
     api_key = conf.get("API").get("KEY")
-    gmaps = googlemaps.Client(key=api_key)
+    gmaps = make_client(api_key, conf.get("executor"))
+    cache = ResponseCache.from_conf(conf.get("cache"))
+    if cache is not None:
+        page_delay = conf.get("search", {}).get("page_delay", 2)
+        gmaps = CachedClient(gmaps, cache, page_delay)
 
     grid_geocode_file = conf.get("input").get("filename")
     place_types = conf.get("input").get("query").split(",")
@@ -60,35 +261,102 @@ def main(config_file):
     grids = load_grids(grid_geocode_file)
     logging.info("Geocode of %s grids loaded from %s", len(grids), grid_geocode_file)
     locations = []
-    place_ids = []
+    place_ids = set()
     counter = 0
-    logging.info("Start querying places of interest for each city grid ...")
-    start_time = time.time()
-    for grid in grids:
+    metrics.start_stage("query")
+    search_conf = conf.get("search", {})
+    if search_conf.get("mode", "grid") == "quadtree":
+        cells, points = cover_cells(
+            grids,
+            float(search_conf.get("cell_size", 8)),
+            float(search_conf.get("margin", 0.005)),
+        )
+        logging.info(
+            "Start searching places of interest from %s cells of %s km "
+            "with %s workers ...",
+            len(cells),
+            search_conf.get("cell_size", 8),
+            executor.workers,
+        )
+        num_requests = 0
         for place_type in place_types:
+            for worker, results in quadtree_search(
+                executor, gmaps, cells, points, place_type, search_conf
+            ):
+                logging.debug(
+                    "Processed cell at %s at depth %s - %s with radius of %s",
+                    worker.cell.center,
+                    worker.cell.depth,
+                    place_type,
+                    int(worker.cell.radius),
+                )
+                num_requests += worker.requests
+                metrics.count("places_requests", worker.requests)
+                metrics.count(
+                    "places_found",
+                    add_places(results, place_type, place_ids, locations),
+                )
+                counter += 1
+                metrics.count("cells_processed")
+                if counter % 100 == 0:
+                    logging.info(
+                        "%s cells processed ... Elapsed time %s seconds",
+                        counter,
+                        metrics.elapsed(),
+                    )
+        logging.info(
+            "%s cells searched with %s requests",
+            counter,
+            num_requests,
+        )
+    else:
+        logging.info(
+            "Start querying places of interest for each city grid "
+            "with %s workers ...",
+            executor.workers,
+        )
+        workers = (
+            PlacesAPIWorker(gmaps, grid, place_type, radius)
+            for grid in grids
+            for place_type in place_types
+        )
+        for places_api_worker, results in executor.map(
+            lambda worker: (worker, worker.run()), workers
+        ):
             logging.debug(
-                "Processing grid %s - %s with radius of %s",
-                grid["id"],
-                place_type,
+                "Processed grid %s - %s with radius of %s",
+                places_api_worker.grid["id"],
+                places_api_worker.query,
                 radius,
             )
-            places_api_worker = PlacesAPIWorker(gmaps, grid, place_type, radius)
-            results = places_api_worker.run()
-            if results is not None:
-                for result in results:
-                    if result.get("place_id"):
-                        place_id = result.get("place_id")
-                        if place_id not in place_ids:
-                            place_ids.append(place_id)
-                            result["place_type"] = place_type
-                            locations.append(result)
-        counter += 1
-        if counter % 100 == 0:
-            logging.info(
-                "%s city grid processed ... Elapsed time %s seconds",
-                counter,
-                round(time.time() - start_time, 4),
+            metrics.count("places_requests")
+            metrics.count(
+                "places_found",
+                add_places(results, places_api_worker.query, place_ids, locations),
             )
+            if places_api_worker.query != place_types[-1]:
+                continue
+            counter += 1
+            metrics.count("grids_processed")
+            if counter % 100 == 0:
+                logging.info(
+                    "%s city grid processed ... Elapsed time %s seconds",
+                    counter,
+                    metrics.elapsed(),
+                )
+    metrics.stop_stage()
+    logging.info("%s requests retried", executor.retries)
+    if cache is not None:
+        logging.info(
+            "Response cache: %s hits, %s misses, hit rate %s",
+            cache.hits,
+            cache.misses,
+            round(cache.hit_rate(), 4),
+        )
+        metrics.gauge("cache_hits", cache.hits)
+        metrics.gauge("cache_misses", cache.misses)
+        metrics.gauge("cache_hit_rate", round(cache.hit_rate(), 4))
+        cache.close()
 
     # Export query responses to file
     if len(locations) > 0:
@@ -100,6 +368,7 @@ def main(config_file):
             len(locations),
             locations_fp,
         )
+    metrics.write()
 
 
 if __name__ == "__main__":
@@ -107,9 +376,14 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c", "--config", required=True, help="directory of the config file"
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
     args = parser.parse_args()
     try:
-        main(args.config)
+        main(args.config, profile=args.profile)
     except Exception:
         logging.exception("Unhandled error during processing")
         raise
@@ -0,0 +1,247 @@
+import argparse
+import logging
+import logging.config
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yaml
+from addict import Dict as Addict
+
+from artifacts import write_table
+from grid_index import GridIndex
+from metrics import Metrics
+from projection import grid_bounds_lnglat
+from travel_time_matrix import TravelTimeMatrix
+
+# Assumptions of grid_population_layer_builder, the centre of the scenarios
+BUNGALOW_SHARE = 0.05  # share of district population living in bungalows
+BUNGALOW_OCCUPANCY = 5  # people per 100 m2 of bungalow floor area
+
+
+def sample(conf, size, rng, default):
+    """Draws of a parameter: constant (value), uniform (low, high), normal
+    (mean, sd) or lognormal (median, sigma).
+    """
+    conf = conf or {}
+    distribution = conf.get("distribution", "constant")
+    if distribution == "constant":
+        return np.full(size, float(conf.get("value", default)))
+    if distribution == "uniform":
+        return rng.uniform(conf.get("low", default), conf.get("high", default), size)
+    if distribution == "normal":
+        return rng.normal(conf.get("mean", default), conf.get("sd", 0), size)
+    if distribution == "lognormal":
+        return conf.get("median", default) * rng.lognormal(
+            0, conf.get("sigma", 0), size
+        )
+    raise ValueError("Unknown distribution: %s" % distribution)
+
+
+def sample_parameters(parameters_conf, num_scenarios, district_population, rng):
+    """Parameter sets of the scenarios, one row per scenario."""
+    error = sample(
+        parameters_conf.get("district_population_error"),
+        (num_scenarios, len(district_population)),
+        rng,
+        1.0,
+    )
+    return {
+        "district_population": np.asarray(district_population, dtype=float) * error,
+        "bungalow_share": sample(
+            parameters_conf.get("bungalow_share"), num_scenarios, rng, BUNGALOW_SHARE
+        ),
+        "bungalow_occupancy": sample(
+            parameters_conf.get("bungalow_occupancy"),
+            num_scenarios,
+            rng,
+            BUNGALOW_OCCUPANCY,
+        ),
+    }
+
+
+def load_floor_areas(grid_file, buildings_file):
+    """Grid ids and districts with their number of residential buildings
+    and the total floor area of their apartments and of their bungalows,
+    computed as in grid_population_layer_builder.
+    """
+    grid_df = pd.read_csv(grid_file).dropna()
+    index = GridIndex(np.arange(len(grid_df)), *grid_bounds_lnglat(grid_df))
+    buildings_df = pd.read_csv(
+        buildings_file, usecols=["type", "area", "center_lng", "center_lat"]
+    )
+    positions = index.query(
+        buildings_df["center_lng"].values, buildings_df["center_lat"].values
+    )
+    found = positions >= 0
+    bungalow = (buildings_df["type"].values == "bungalow")[found]
+    areas = buildings_df["area"].values[found]
+    return pd.DataFrame(
+        {
+            "id": grid_df["id"].values.astype(np.int64),
+            "district": grid_df["district"].values,
+            "buildings": np.bincount(positions[found], minlength=len(grid_df)),
+            "area": np.bincount(
+                positions[found], np.where(bungalow, 0, areas), len(grid_df)
+            ),
+            "area_bungalow": np.bincount(
+                positions[found], np.where(bungalow, areas, 0), len(grid_df)
+            ),
+        }
+    )
+
+
+def evaluate_chunk(area, area_bungalow, district, district_area, params, counts, q):
+    """Percentiles over the scenarios of the population and density of a
+    chunk of grids, evaluated as (scenarios x grids) arrays.
+    @param district: position of the district of each grid
+    @param district_area: apartment floor area of each district
+    @param counts: supermarkets within reach of each grid, None to skip
+        the density
+
+    """
+    apartment_population = params["district_population"] * (
+        1 - params["bungalow_share"][:, None]
+    )
+    # Districts without apartment floor area take no apartment population
+    has_area = district_area > 0
+    per_area = np.where(
+        has_area[None, :],
+        apartment_population / np.where(has_area, district_area, 1)[None, :],
+        0,
+    )
+    population = (
+        per_area[:, district] * area[None, :]
+        + area_bungalow[None, :] * params["bungalow_occupancy"][:, None] / 100
+    )
+    population_q = np.percentile(population, q, axis=0)
+    if counts is None:
+        return population_q, None
+    density = population / np.maximum(counts, 1)[None, :]
+    return population_q, np.percentile(density, q, axis=0)
+
+
+def run_scenarios(areas_df, district_population, params, counts, q, conf):
+    """Evaluate the scenarios on chunks of grids across worker processes.
+    Returns the percentiles of population and density, one row per
+    percentile and one column per grid.
+    """
+    # District populations are listed in the order of the districts with
+    # buildings, as grouped by grid_population_layer_builder
+    districts = np.sort(areas_df.loc[areas_df["buildings"] > 0, "district"].unique())
+    if len(districts) != len(district_population):
+        raise ValueError(
+            "%s districts with buildings but %s district populations"
+            % (len(districts), len(district_population))
+        )
+    district = np.searchsorted(districts, areas_df["district"].values)
+    # Grids of districts without any building have no floor area either
+    district = np.minimum(district, len(districts) - 1)
+    area = areas_df["area"].values
+    area_bungalow = areas_df["area_bungalow"].values
+    district_area = np.bincount(district, area, minlength=len(districts))
+    chunk_size = int(conf.get("chunk_size", 2000))
+    chunks = [
+        slice(start, start + chunk_size) for start in range(0, len(area), chunk_size)
+    ]
+    with ProcessPoolExecutor(max_workers=int(conf.get("workers", 4))) as pool:
+        futures = [
+            pool.submit(
+                evaluate_chunk,
+                area[chunk],
+                area_bungalow[chunk],
+                district[chunk],
+                district_area,
+                params,
+                None if counts is None else counts[chunk],
+                q,
+            )
+            for chunk in chunks
+        ]
+        results = [future.result() for future in futures]
+    population_q = np.concatenate([r[0] for r in results], axis=1)
+    if counts is None:
+        return population_q, None
+    return population_q, np.concatenate([r[1] for r in results], axis=1)
+
+
+def main(config_file, profile=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    metrics = Metrics.from_conf(conf.get("metrics"), "population_scenarios", profile)
+    scenarios_conf = conf.get("scenarios")
+    metrics.start_stage("load_inputs")
+    areas_df = load_floor_areas(
+        conf.get("input").get("grid_file"),
+        conf.get("input").get("residential_buildings_file"),
+    )
+    logging.info("Floor areas of %s grids loaded", len(areas_df))
+    counts = None
+    matrix_file = scenarios_conf.get("travel_time_matrix_file")
+    if matrix_file and os.path.exists(matrix_file):
+        matrix = TravelTimeMatrix.load(matrix_file)
+        rows = matrix.rows_of(areas_df["id"].values)
+        counts = np.zeros(len(rows), dtype=np.int64)
+        counts[rows >= 0] = matrix.counts(scenarios_conf.get("max_driving_time"))[
+            rows[rows >= 0], 0
+        ]
+    else:
+        logging.warning("No travel time matrix, density percentiles skipped")
+
+    metrics.start_stage("evaluate")
+    num_scenarios = int(scenarios_conf.get("num_scenarios", 1000))
+    district_population = conf.get("district_population")
+    params = sample_parameters(
+        scenarios_conf.get("parameters", {}),
+        num_scenarios,
+        district_population,
+        np.random.RandomState(scenarios_conf.get("seed")),
+    )
+    q = list(scenarios_conf.get("percentiles", [5, 50, 95]))
+    population_q, density_q = run_scenarios(
+        areas_df, district_population, params, counts, q, scenarios_conf
+    )
+    metrics.count("scenarios", num_scenarios)
+    logging.info(
+        "%s scenarios evaluated on %s grids ... Elapsed time %s seconds",
+        num_scenarios,
+        len(areas_df),
+        metrics.elapsed(),
+    )
+
+    metrics.start_stage("write_outputs")
+    scenarios_df = areas_df[["id", "district"]].copy()
+    for i, percentile in enumerate(q):
+        scenarios_df["population_p%g" % percentile] = population_q[i]
+    if density_q is not None:
+        for i, percentile in enumerate(q):
+            scenarios_df["density_p%g" % percentile] = density_q[i]
+    logging.info(scenarios_df.head())
+    scenarios_file = conf.get("output").get("population_scenarios_file")
+    write_table(scenarios_df, scenarios_file)
+    logging.info("Population and density percentiles written to %s", scenarios_file)
+    metrics.write()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, profile=args.profile)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
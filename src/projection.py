@@ -0,0 +1,35 @@
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Transformer
+
+WEB_MERCATOR = "epsg:3857"
+WGS84 = "epsg:4326"
+
+
+@lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """One Transformer per CRS pair, built on first use. Coordinates are
+    always in (x, y) i.e. (lng, lat) order.
+    """
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def transform_coords(x, y, src_crs=WEB_MERCATOR, dst_crs=WGS84):
+    """Reproject whole coordinate arrays in a single call."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return get_transformer(src_crs, dst_crs).transform(x, y)
+
+
+def grid_bounds_lnglat(grid_df):
+    """Left, bottom, right and top of the grid cells in lng/lat, from their
+    left, top, right and bottom columns in Web Mercator.
+    """
+    left_lng, top_lat = transform_coords(
+        grid_df["left"].values, grid_df["top"].values, WEB_MERCATOR, WGS84
+    )
+    right_lng, bottom_lat = transform_coords(
+        grid_df["right"].values, grid_df["bottom"].values, WEB_MERCATOR, WGS84
+    )
+    return left_lng, bottom_lat, right_lng, top_lat
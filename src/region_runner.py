@@ -0,0 +1,253 @@
+import argparse
+import logging
+import logging.config
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import shapefile as shp
+import yaml
+from addict import Dict as Addict
+
+import distance_api_parser
+import grid_population_layer_builder
+from grid_index import GridIndex
+from metrics import Metrics
+from osm_preprocessor import extract_buildings
+from projection import grid_bounds_lnglat
+
+
+class RegionRouter:
+    def __init__(self, names, indexes):
+        """Initialization.
+        @param names: names of the regions, in order of priority
+        @param indexes: GridIndex of the grid cells of each region in
+            lng/lat, a building inside the cells of several going to the
+            first one
+
+        """
+        self.names = list(names)
+        self.indexes = list(indexes)
+
+    @classmethod
+    def from_grid_files(cls, names, grid_files):
+        """Index the cells of the grid file of every region as
+        grid_population_layer_builder reads them.
+        """
+        indexes = []
+        for grid_file in grid_files:
+            grid_df = pd.read_csv(grid_file).dropna()
+            indexes.append(
+                GridIndex(np.arange(len(grid_df)), *grid_bounds_lnglat(grid_df))
+            )
+        return cls(names, indexes)
+
+    def bounds(self):
+        """Bounding box of the cells of all the regions."""
+        indexes = [index for index in self.indexes if len(index.ids)]
+        return {
+            "min_lat": min(index.bottom.min() for index in indexes),
+            "max_lat": max(index.top.max() for index in indexes),
+            "min_lng": min(index.left.min() for index in indexes),
+            "max_lng": max(index.right.max() for index in indexes),
+        }
+
+    def route(self, lng, lat):
+        """Position of the region whose grid holds each point, -1 if none.
+        Regions are routed on their cells rather than their bounding boxes,
+        which overlap between neighbouring states, so that every building
+        goes to the region whose population layer counts it.
+        """
+        lng = np.asarray(lng, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        region = np.full(len(lng), -1, dtype=np.int64)
+        for position, index in enumerate(self.indexes):
+            pending = np.flatnonzero(region < 0)
+            found = index.query(lng[pending], lat[pending]) >= 0
+            region[pending[found]] = position
+        return region
+
+
+def region_dir(work_dir, name):
+    return os.path.join(work_dir, name)
+
+
+def route_buildings(conf, router, work_dir, metrics):
+    """Read the building shapefile once and append the residential buildings
+    of every region to residential_buildings.csv in its directory. Returns
+    the number of buildings of each region.
+    """
+    shp_path = conf.get("input").get("building_shape_file")
+    sf = shp.Reader(shp_path)
+    logging.info("%s buildings in %s", len(sf), shp_path)
+    names = router.names
+    counts = dict.fromkeys(names, 0)
+    for name in names:
+        os.makedirs(region_dir(work_dir, name), exist_ok=True)
+    for buildings_df in extract_buildings(
+        sf,
+        conf.get("input").get("residential_types"),
+        router.bounds(),
+        int(conf.get("chunk_size", 10000)),
+        int(conf.get("workers", 1)),
+    ):
+        routed = router.route(
+            buildings_df["center_lng"].values, buildings_df["center_lat"].values
+        )
+        for position in np.unique(routed[routed >= 0]):
+            name = names[position]
+            region_df = buildings_df.loc[routed == position].copy()
+            region_df.index = np.arange(counts[name], counts[name] + len(region_df))
+            region_df.index.name = "id"
+            region_df.to_csv(
+                os.path.join(region_dir(work_dir, name), "residential_buildings.csv"),
+                mode="a" if counts[name] else "w",
+                header=not counts[name],
+                index=True,
+            )
+            counts[name] += len(region_df)
+        metrics.count("buildings_routed", int(np.sum(routed >= 0)))
+        logging.info(
+            "%s residential buildings routed ... Elapsed time %s seconds",
+            sum(counts.values()),
+            metrics.elapsed(),
+        )
+    return counts
+
+
+def region_configs(conf, name, region, work_dir):
+    """Configs of grid_population_layer_builder and, when the region has
+    distance responses, distance_api_parser, with every output in the
+    directory of the region.
+    """
+    path = region_dir(work_dir, name)
+    builder_conf = {
+        "input": {
+            "grid_file": region["grid_file"],
+            "residential_buildings_file": os.path.join(
+                path, "residential_buildings.csv"
+            ),
+            "grid_shape_file": region["grid_shape_file"],
+        },
+        "district_population": list(region["district_population"]),
+        "output": {
+            "grid_geocode_file": os.path.join(path, "grid_center_geocode.csv"),
+            "grid_population_file": os.path.join(path, "grid_population.parquet"),
+            "grid_population_shape_file": os.path.join(
+                path, "grid_population.geo.parquet"
+            ),
+        },
+        "metrics": {"path": os.path.join(path, "metrics.jsonl")},
+    }
+    if not region.get("grid_to_supermarket_dist_raw"):
+        return builder_conf, None
+    density_conf = conf.get("density", {})
+    parser_conf = {
+        "max_driving_time": density_conf.get("max_driving_time", 1200),
+        "density_thresholds": list(density_conf.get("density_thresholds") or []),
+        "accessibility": dict(density_conf.get("accessibility") or {}),
+        "input": {
+            "grid_population_file": builder_conf["output"]["grid_population_file"],
+            "grid_shape_file": region["grid_shape_file"],
+        },
+        "output": {
+            "grid_to_supermarket_dist_raw": region["grid_to_supermarket_dist_raw"],
+            "grid_to_supermarket_dist_data": os.path.join(
+                path, "grid_to_supermarket_dist.parquet"
+            ),
+            "travel_time_matrix_file": os.path.join(path, "travel_time_matrix.npz"),
+            "supermarket_density_file": os.path.join(
+                path, "supermarket_density.parquet"
+            ),
+            "supermarket_density_shape_file": os.path.join(
+                path, "supermarket_density.geo.parquet"
+            ),
+        },
+        "metrics": {"path": os.path.join(path, "metrics.jsonl")},
+    }
+    return builder_conf, parser_conf
+
+
+def run_region(name, builder_conf, parser_conf):
+    """Population and density stages of a region, run in a worker process."""
+    start_time = time.time()
+    grid_population_layer_builder.main(builder_conf)
+    if parser_conf is not None:
+        distance_api_parser.main(parser_conf)
+    return name, round(time.time() - start_time, 4)
+
+
+def main(config_file, names=None, profile=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    metrics = Metrics.from_conf(conf.get("metrics"), "region_runner", profile)
+    table = conf.get("regions")
+    unknown = set(names or []) - set(table)
+    if unknown:
+        raise ValueError("Unknown regions: %s" % sorted(unknown))
+    names = [name for name in table if not names or name in names]
+    work_dir = conf.get("work_dir", "data/regions")
+
+    metrics.start_stage("route_buildings")
+    router = RegionRouter.from_grid_files(
+        names, [table[name]["grid_file"] for name in names]
+    )
+    counts = route_buildings(conf, router, work_dir, metrics)
+    for name in names:
+        logging.info("%s: %s residential buildings", name, counts[name])
+        metrics.gauge("buildings_%s" % name, counts[name])
+        if not counts[name]:
+            logging.warning("No residential building in %s, skipped", name)
+
+    metrics.start_stage("build_regions")
+    failed = []
+    with ProcessPoolExecutor(max_workers=int(conf.get("region_workers", 4))) as pool:
+        futures = {
+            pool.submit(
+                run_region,
+                name,
+                *region_configs(conf, name, table[name], work_dir),
+            ): name
+            for name in names
+            if counts[name]
+        }
+        for future in as_completed(futures):
+            try:
+                name, seconds = future.result()
+            except Exception:
+                logging.exception("Region %s failed", futures[future])
+                failed.append(futures[future])
+                continue
+            metrics.count("regions_built")
+            logging.info("Region %s built ... Elapsed time %s seconds", name, seconds)
+    metrics.write()
+    if failed:
+        raise RuntimeError("Regions failed: %s" % sorted(failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "regions", nargs="*", help="regions of the table to process, all by default"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, args.regions, profile=args.profile)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from googlemaps.exceptions import ApiError
+
+
+def normalize_location(location, precision):
+    """Round a (lat, lng) pair or a "lat,lng" string to a fixed precision."""
+    if isinstance(location, str):
+        location = location.split(",")
+    lat, lng = location
+    return (round(float(lat), precision), round(float(lng), precision))
+
+
+def is_scalar_pair(locations):
+    return len(locations) == 2 and all(
+        not isinstance(value, (list, tuple, dict)) and "," not in str(value)
+        for value in locations
+    )
+
+
+def normalize_locations(locations, precision):
+    """Normalize one location or a list of locations into a list of rounded
+    (lat, lng) tuples.
+    """
+    if isinstance(locations, str) or is_scalar_pair(locations):
+        locations = [locations]
+    return [normalize_location(location, precision) for location in locations]
+
+
+class ResponseCache:
+    def __init__(self, path, ttl=None, max_entries=None, precision=5):
+        """Initialization.
+        @param path: SQLite file holding the cached responses
+        @param ttl: seconds before an entry expires, never if None
+        @param max_entries: entries kept before the least recently used
+            ones are evicted, unbounded if None
+        @param precision: decimal places of the coordinates in cache keys
+
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = float(ttl) if ttl else None
+        self.max_entries = int(max_entries) if max_entries else None
+        self.precision = int(precision)
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Build a cache from the cache section of a config file, or return
+        None when caching is disabled.
+        """
+        if not conf or not conf.get("enabled"):
+            return None
+        return cls(
+            conf.get("path"),
+            ttl=conf.get("ttl"),
+            max_entries=conf.get("max_entries"),
+            precision=conf.get("precision", 5),
+        )
+
+    @staticmethod
+    def make_key(endpoint, **params):
+        return json.dumps([endpoint, params], sort_keys=True, separators=(",", ":"))
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self.puts += 1
+            if self.max_entries and self.puts % 1000 == 0:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """Drop the least recently used entries beyond max_entries."""
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count <= self.max_entries:
+            return
+        self.conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+            (count - self.max_entries,),
+        )
+        logging.info("%s entries evicted from cache", count - self.max_entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        with self.lock:
+            if self.max_entries:
+                self.evict()
+            self.conn.commit()
+            self.conn.close()
+
+
+class CachedClient:
+    def __init__(self, gmaps, cache, page_delay=2):
+        """Initialization.
+        @param gmaps: googlemaps.Client answering the cache misses
+        @param cache: ResponseCache
+        @param page_delay: seconds before a next_page_token of the Places
+            API becomes valid
+
+        Distance Matrix responses are cached per (origin, destination)
+        element, so a batch that differs from a previous run only requests
+        the origins and destinations it has not seen yet.
+
+        Places pages are cached per query and page index. Page tokens of the
+        API expire shortly after they are issued, so the responses handed
+        out carry local tokens instead, and stored tokens are never sent.
+
+        """
+        self.gmaps = gmaps
+        self.cache = cache
+        self.page_delay = float(page_delay)
+        # Local token: (page index, token of the API if issued in this run)
+        self.page_tokens = {}
+
+    def __getattr__(self, name):
+        return getattr(self.gmaps, name)
+
+    def distance_matrix(self, origins, destinations, mode="driving"):
+        precision = self.cache.precision
+        origin_keys = normalize_locations(origins, precision)
+        destination_keys = normalize_locations(destinations, precision)
+        cached = {}
+        missing_origins, missing_destinations = set(), set()
+        for i, origin in enumerate(origin_keys):
+            for j, destination in enumerate(destination_keys):
+                key = self.cache.make_key(
+                    "distance_matrix",
+                    origin=origin,
+                    destination=destination,
+                    mode=mode,
+                )
+                value = self.cache.get(key)
+                if value is None:
+                    missing_origins.add(i)
+                    missing_destinations.add(j)
+                else:
+                    cached[i, j] = value
+
+        if missing_origins:
+            missing_origins = sorted(missing_origins)
+            missing_destinations = sorted(missing_destinations)
+            response = self.gmaps.distance_matrix(
+                [origin_keys[i] for i in missing_origins],
+                [destination_keys[j] for j in missing_destinations],
+                mode=mode,
+            )
+            origin_addresses = response.get("origin_addresses") or []
+            destination_addresses = response.get("destination_addresses") or []
+            for row, i, origin_address in zip(
+                response.get("rows") or [], missing_origins, origin_addresses
+            ):
+                for element, j, destination_address in zip(
+                    row.get("elements") or [],
+                    missing_destinations,
+                    destination_addresses,
+                ):
+                    value = {
+                        "origin_address": origin_address,
+                        "destination_address": destination_address,
+                        "element": element,
+                    }
+                    key = self.cache.make_key(
+                        "distance_matrix",
+                        origin=origin_keys[i],
+                        destination=destination_keys[j],
+                        mode=mode,
+                    )
+                    self.cache.put(key, value)
+                    cached[i, j] = value
+
+        origin_addresses = [None] * len(origin_keys)
+        destination_addresses = [None] * len(destination_keys)
+        rows = []
+        for i in range(len(origin_keys)):
+            elements = []
+            for j in range(len(destination_keys)):
+                value = cached.get((i, j))
+                if value is None:
+                    elements.append({"status": "NOT_FOUND"})
+                    continue
+                origin_addresses[i] = value["origin_address"]
+                destination_addresses[j] = value["destination_address"]
+                elements.append(value["element"])
+            rows.append({"elements": elements})
+        return {
+            "destination_addresses": destination_addresses,
+            "origin_addresses": origin_addresses,
+            "rows": rows,
+            "status": "OK",
+        }
+
+    def places(self, query, location=None, radius=None, page_token=None):
+        if location is not None:
+            location = normalize_location(location, self.cache.precision)
+        page, api_token = 0, None
+        if page_token is not None:
+            if page_token not in self.page_tokens:
+                # A token this client did not hand out
+                return self.gmaps.places(
+                    query, location=location, radius=radius, page_token=page_token
+                )
+            page, api_token = self.page_tokens[page_token]
+        response = self.cache.get(self.page_key(query, location, radius, page))
+        fresh = response is None
+        if fresh:
+            if page == 0 or api_token is not None:
+                response = self.gmaps.places(
+                    query, location=location, radius=radius, page_token=api_token
+                )
+                self.cache.put(self.page_key(query, location, radius, page), response)
+            else:
+                response = self.refetch(query, location, radius, page)
+        self.page_tokens.pop(page_token, None)
+        return self.hand_out(response, page, fresh)
+
+    def page_key(self, query, location, radius, page):
+        return self.cache.make_key(
+            "places", query=query, location=location, radius=radius, page=page
+        )
+
+    def hand_out(self, response, page, fresh):
+        """Copy of a page with its next_page_token replaced by a local one."""
+        response = dict(response)
+        if response.get("next_page_token"):
+            token = uuid.uuid4().hex
+            # Tokens of cached pages may have expired, only fresh ones are sent
+            self.page_tokens[token] = (
+                page + 1,
+                response["next_page_token"] if fresh else None,
+            )
+            response["next_page_token"] = token
+        return response
+
+    def refetch(self, query, location, radius, page):
+        """Fetch a page no longer cached behind cached earlier pages, walking
+        the pages of the search again from the first with fresh tokens.
+        """
+        response = self.gmaps.places(query, location=location, radius=radius)
+        self.cache.put(self.page_key(query, location, radius, 0), response)
+        for index in range(1, page + 1):
+            if not response.get("next_page_token"):
+                return {"results": [], "status": "ZERO_RESULTS"}
+            for attempt in range(3):
+                time.sleep(self.page_delay)
+                try:
+                    next_response = self.gmaps.places(
+                        query,
+                        location=location,
+                        radius=radius,
+                        page_token=response["next_page_token"],
+                    )
+                    break
+                except ApiError as exc:
+                    # The token is not valid until a short time after it is issued
+                    if exc.status != "INVALID_REQUEST" or attempt == 2:
+                        raise
+            response = next_response
+            self.cache.put(self.page_key(query, location, radius, index), response)
+        return response
@@ -0,0 +1,263 @@
+import logging
+import os
+import time
+
+import numpy as np
+import shapefile as shp
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from spatial_prefilter import haversine, to_unit_vectors
+
+MIN_EDGE_TIME = 1e-3  # in seconds, keeps zero-length segments as edges
+
+
+def load_road_segments(roads_file, speeds, bbox=None):
+    """Read the drivable segments of an OSM roads shapefile in the Geofabrik
+    layout. Returns start and end points of every directed segment and its
+    speed in km/h.
+
+    Roads whose fclass has no speed are not drivable. maxspeed, when tagged,
+    overrides the speed of the class. oneway "F" follows the digitizing
+    direction, "T" goes against it, anything else is two-way.
+    """
+    sf = shp.Reader(roads_file)
+    starts, ends, segment_speeds = [], [], []
+    for shape_record in sf.iterShapeRecords(
+        fields=["fclass", "oneway", "maxspeed"], bbox=bbox
+    ):
+        record = shape_record.record
+        speed = speeds.get(record["fclass"])
+        if speed is None or len(shape_record.shape.points) < 2:
+            continue
+        if record["maxspeed"]:
+            speed = float(record["maxspeed"])
+        points = np.asarray(shape_record.shape.points, dtype=float)
+        if record["oneway"] == "T":
+            points = points[::-1]
+        directions = [points]
+        if record["oneway"] not in ("F", "T"):
+            directions.append(points[::-1])
+        for line in directions:
+            starts.append(line[:-1])
+            ends.append(line[1:])
+            segment_speeds.append(np.full(len(line) - 1, speed))
+    if not starts:
+        raise ValueError("No drivable road found in %s" % roads_file)
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(segment_speeds)
+
+
+class RoadNetwork:
+    def __init__(self, nodes, tails, heads, times, lengths):
+        """Initialization.
+        @param nodes: (lng, lat) of the graph nodes
+        @param tails, heads: node indices of the directed edges
+        @param times: driving time of the edges in seconds
+        @param lengths: length of the edges in meter
+
+        Parallel edges are reduced to the fastest one.
+
+        """
+        self.nodes = np.asarray(nodes, dtype=float)
+        num_nodes = len(self.nodes)
+        order = np.lexsort((times, heads, tails))
+        tails, heads, times, lengths = (
+            tails[order],
+            heads[order],
+            times[order],
+            lengths[order],
+        )
+        keys = tails.astype(np.int64) * num_nodes + heads
+        first = np.concatenate([[True], keys[1:] != keys[:-1]])
+        self.keys = keys[first]
+        self.lengths = lengths[first]
+        self.graph = csr_matrix(
+            (np.maximum(times[first], MIN_EDGE_TIME), (tails[first], heads[first])),
+            shape=(num_nodes, num_nodes),
+        )
+        self.tree = cKDTree(to_unit_vectors(self.nodes[:, 1], self.nodes[:, 0]))
+
+    @classmethod
+    def from_segments(cls, starts, ends, speeds, precision=7):
+        """Build the graph, merging segment ends that share coordinates to
+        the given number of decimal places.
+        """
+        points = np.round(np.concatenate([starts, ends]), precision)
+        nodes, index = np.unique(points, axis=0, return_inverse=True)
+        index = index.reshape(-1)
+        num_segments = len(starts)
+        tails, heads = index[:num_segments], index[num_segments:]
+        lengths = haversine(starts[:, 1], starts[:, 0], ends[:, 1], ends[:, 0])
+        times = lengths / (speeds / 3.6)
+        return cls(nodes, tails, heads, times, lengths)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Load the graph from graph_file, or build it from roads_file and
+        save it there for the next run.
+        """
+        graph_file = conf.get("graph_file")
+        if graph_file and os.path.exists(graph_file):
+            logging.info("Loading road graph from %s", graph_file)
+            return cls.load(graph_file)
+        start_time = time.time()
+        starts, ends, speeds = load_road_segments(
+            conf.get("roads_file"), dict(conf.get("speeds")), conf.get("bbox")
+        )
+        network = cls.from_segments(starts, ends, speeds)
+        logging.info(
+            "Road graph of %s nodes and %s edges built ... Elapsed time %s seconds",
+            len(network.nodes),
+            network.graph.nnz,
+            round(time.time() - start_time, 4),
+        )
+        if graph_file:
+            network.save(graph_file)
+        return network
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        coo = self.graph.tocoo()
+        np.savez(
+            path,
+            nodes=self.nodes,
+            tails=coo.row,
+            heads=coo.col,
+            times=coo.data,
+            lengths=self.lengths,
+        )
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(
+            arrays["nodes"],
+            arrays["tails"],
+            arrays["heads"],
+            arrays["times"],
+            arrays["lengths"],
+        )
+
+    def snap(self, lat, lng):
+        """Nearest node of each location and the straight-line distance to it."""
+        _, index = self.tree.query(to_unit_vectors(lat, lng))
+        offsets = haversine(lat, lng, self.nodes[index, 1], self.nodes[index, 0])
+        return index, offsets
+
+    def edge_lengths(self, tails, heads):
+        keys = tails.astype(np.int64) * len(self.nodes) + heads
+        return self.lengths[np.searchsorted(self.keys, keys)]
+
+    def times_to(self, targets, limit):
+        """Driving time and distance from every node to each target node,
+        searched backwards from the targets up to limit seconds. Nodes
+        beyond the limit get inf.
+        """
+        times, predecessors = dijkstra(
+            self.graph.T.tocsr(),
+            indices=targets,
+            limit=limit,
+            return_predecessors=True,
+        )
+        # predecessors point to the next node on the way to the target, so
+        # path lengths add up by pointer jumping in log(depth) passes
+        reached = predecessors >= 0
+        distances = np.zeros(times.shape)
+        rows, columns = np.nonzero(reached)
+        distances[rows, columns] = self.edge_lengths(
+            columns, predecessors[rows, columns]
+        )
+        hops = np.where(reached, predecessors, -1)
+        rows = np.arange(len(targets))[:, None]
+        while (hops >= 0).any():
+            following = hops >= 0
+            step = np.where(following, hops, 0)
+            distances = distances + np.where(following, distances[rows, step], 0)
+            hops = np.where(following, hops[rows, step], -1)
+        return times, distances
+
+
+def pair_response(city_grid, supermarket, duration=None, distance=None):
+    """Record shaped like the response of a 1 x 1 Distance Matrix request."""
+    response = {
+        "destination_addresses": [],
+        "origin_addresses": [],
+        "rows": [],
+        "status": "UNREACHABLE",
+        "grid_id": city_grid.get("id"),
+        "supermarket_id": supermarket.get("index"),
+    }
+    if duration is not None:
+        response["status"] = "OK"
+        element = {
+            "status": "OK",
+            "duration": {"value": int(round(duration))},
+            "distance": {"value": int(round(distance))},
+        }
+        response["rows"].append({"elements": [element]})
+    return response
+
+
+class RoadNetworkBackend:
+    def __init__(self, network, max_driving_time, access_speed, targets_per_pass):
+        """Initialization.
+        @param network: RoadNetwork
+        @param max_driving_time: search cutoff in seconds, pairs beyond it
+            are reported as unreachable
+        @param access_speed: km/h between a location and its nearest node
+        @param targets_per_pass: supermarkets searched in one Dijkstra pass,
+            bounding memory to targets_per_pass x nodes
+
+        """
+        self.network = network
+        self.max_driving_time = float(max_driving_time)
+        self.access_speed = float(access_speed)
+        self.targets_per_pass = int(targets_per_pass)
+
+    @classmethod
+    def from_conf(cls, conf, max_driving_time):
+        return cls(
+            RoadNetwork.from_conf(conf),
+            max_driving_time,
+            conf.get("access_speed", 15),
+            conf.get("targets_per_pass", 16),
+        )
+
+    def iter_responses(self, grids, supermarkets, completed=(), candidates=None):
+        """Yield one response per (grid, supermarket) pair not in completed.
+        Every pair is solved locally, so candidates are not needed.
+        """
+        grid_nodes, grid_offsets = self.network.snap(
+            np.array([float(grid["center_lat"]) for grid in grids]),
+            np.array([float(grid["center_lng"]) for grid in grids]),
+        )
+        store_nodes, store_offsets = self.network.snap(
+            np.array([float(supermarket["lat"]) for supermarket in supermarkets]),
+            np.array([float(supermarket["lng"]) for supermarket in supermarkets]),
+        )
+        access_times = (grid_offsets[None, :] + store_offsets[:, None]) / (
+            self.access_speed / 3.6
+        )
+        for start in range(0, len(supermarkets), self.targets_per_pass):
+            stop = start + self.targets_per_pass
+            times, distances = self.network.times_to(
+                store_nodes[start:stop], self.max_driving_time
+            )
+            times = times[:, grid_nodes] + access_times[start:stop]
+            distances = (
+                distances[:, grid_nodes]
+                + grid_offsets[None, :]
+                + store_offsets[start:stop, None]
+            )
+            for i, supermarket in enumerate(supermarkets[start:stop]):
+                for j, grid in enumerate(grids):
+                    if (grid.get("id"), supermarket.get("index")) in completed:
+                        continue
+                    if times[i, j] > self.max_driving_time:
+                        yield pair_response(grid, supermarket)
+                    else:
+                        yield pair_response(
+                            grid, supermarket, times[i, j], distances[i, j]
+                        )
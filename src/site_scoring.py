@@ -0,0 +1,219 @@
+import argparse
+import heapq
+import logging
+import logging.config
+
+import numpy as np
+import pandas as pd
+import yaml
+from addict import Dict as Addict
+
+from artifacts import read_table, write_table
+from distance_api_parser import compute_density
+from metrics import Metrics
+from spatial_prefilter import StoreIndex, search_radius
+from travel_time_matrix import TravelTimeMatrix
+
+
+class SiteScorer:
+    def __init__(self, grid_ids, lat, lng, population, counts, reach_radius):
+        """Initialization.
+        @param grid_ids: ids of the city grids
+        @param lat, lng: geocode of the grid centers
+        @param population: population of each grid
+        @param counts: supermarkets reachable from each grid, updated in
+            place as sites are opened
+        @param reach_radius: straight-line distance in meter within which
+            a candidate site is assumed reachable from a grid center
+
+        """
+        self.grid_ids = np.asarray(grid_ids)
+        self.lat = np.asarray(lat, dtype=float)
+        self.lng = np.asarray(lng, dtype=float)
+        self.population = np.asarray(population, dtype=float)
+        self.counts = np.asarray(counts, dtype=np.int64).copy()
+        self.reach_radius = float(reach_radius)
+        self.index = StoreIndex(lat, lng)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Reachability of the existing supermarkets from the travel time
+        matrix saved by distance_api_parser, population from the grid
+        population layer.
+        """
+        grid_geocode_file = conf.get("input").get("grid_geocode_file")
+        grids_df = pd.read_csv(
+            grid_geocode_file, usecols=["id", "center_lat", "center_lng"]
+        )
+        population_df = read_table(
+            conf.get("input").get("grid_population_file"),
+            columns=["id", "population"],
+            memory_map=True,
+        )
+        grids_df = pd.merge(grids_df, population_df, on="id", how="inner")
+        matrix = TravelTimeMatrix.load(
+            conf.get("output").get("travel_time_matrix_file")
+        )
+        grid_ids = grids_df["id"].values.astype(np.int64)
+        rows = matrix.rows_of(grid_ids)
+        counts = np.zeros(len(grid_ids), dtype=np.int64)
+        counts[rows >= 0] = matrix.counts(conf.get("max_driving_time"))[
+            rows[rows >= 0], 0
+        ]
+        scoring_conf = conf.get("site_scoring", {})
+        return cls(
+            grid_ids,
+            grids_df["center_lat"].values,
+            grids_df["center_lng"].values,
+            grids_df["population"].values,
+            counts,
+            search_radius(
+                conf.get("max_driving_time"), scoring_conf.get("reach_speed", 30)
+            ),
+        )
+
+    def reach(self, lat, lng):
+        """Positions of the grids reached from each site."""
+        return [
+            np.asarray(indices, dtype=np.int64)
+            for indices in self.index.query_radius(lat, lng, self.reach_radius)
+        ]
+
+    def gain(self, reached):
+        """Population a new supermarket would serve: its share of each
+        reached grid, the grid population over the supermarkets reaching it
+        once the site is opened.
+        """
+        return float(np.sum(self.population[reached] / (self.counts[reached] + 1)))
+
+    def score(self, lat, lng):
+        """Gain of each candidate site given the supermarkets open now, only
+        touching the grids each site reaches.
+        """
+        reached = self.reach(lat, lng)
+        sizes = np.array([len(indices) for indices in reached], dtype=np.int64)
+        if not sizes.sum():
+            return np.zeros(len(reached))
+        grids = np.concatenate(reached)
+        shares = self.population[grids] / (self.counts[grids] + 1)
+        return np.bincount(
+            np.repeat(np.arange(len(reached)), sizes), shares, minlength=len(reached)
+        )
+
+    def open_site(self, reached):
+        self.counts[reached] += 1
+
+    def density(self):
+        """Population per reachable supermarket of each grid, as written to
+        supermarket_density.
+        """
+        return compute_density(
+            np.arange(len(self.counts)), self.population, self.counts
+        )
+
+    def select(self, lat, lng, k):
+        """Open k of the candidate sites one at a time, each time the one of
+        largest gain. Gains only shrink as sites are opened, so a stale gain
+        is an upper bound and only the top of the heap is re-evaluated.
+        Returns the positions of the selected sites and their gains.
+        """
+        reached = self.reach(lat, lng)
+        heap = [(-gain, i) for i, gain in enumerate(self.score(lat, lng))]
+        heapq.heapify(heap)
+        fresh = set(range(len(reached)))
+        selected = []
+        gains = []
+        while heap and len(selected) < k:
+            _, i = heapq.heappop(heap)
+            if i not in fresh:
+                heapq.heappush(heap, (-self.gain(reached[i]), i))
+                fresh.add(i)
+                continue
+            gain = self.gain(reached[i])
+            selected.append(i)
+            gains.append(gain)
+            self.open_site(reached[i])
+            fresh = set()
+        return selected, gains
+
+
+def load_candidates(candidates_file, scorer):
+    """Candidate sites with id, lat and lng, the grid centers if no file."""
+    if candidates_file:
+        return pd.read_csv(candidates_file, usecols=["id", "lat", "lng"])
+    return pd.DataFrame({"id": scorer.grid_ids, "lat": scorer.lat, "lng": scorer.lng})
+
+
+def main(config_file, profile=False):
+    conf = Addict(yaml.safe_load(open(config_file, "r")))
+    if conf.get("logging") is not None:
+        logging.config.dictConfig(conf["logging"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
+    metrics = Metrics.from_conf(conf.get("metrics"), "site_scoring", profile)
+    scoring_conf = conf.get("site_scoring", {})
+    metrics.start_stage("load_inputs")
+    scorer = SiteScorer.from_conf(conf)
+    candidates_df = load_candidates(scoring_conf.get("candidates_file"), scorer)
+    logging.info(
+        "%s grids and %s candidate sites loaded, sites reach %s m",
+        len(scorer.grid_ids),
+        len(candidates_df),
+        round(scorer.reach_radius),
+    )
+    density = scorer.density()
+    unserved = scorer.population[scorer.counts == 0].sum()
+
+    metrics.start_stage("score")
+    lat = candidates_df["lat"].values
+    lng = candidates_df["lng"].values
+    candidates_df["gain"] = scorer.score(lat, lng)
+    metrics.count("sites_scored", len(candidates_df))
+    logging.info(
+        "%s candidate sites scored ... %s sites per second",
+        len(candidates_df),
+        round(len(candidates_df) / max(metrics.elapsed(), 1e-6)),
+    )
+
+    metrics.start_stage("select")
+    top_k = int(scoring_conf.get("top_k", 10))
+    selected, gains = scorer.select(lat, lng, top_k)
+    sites_df = candidates_df.iloc[selected].copy()
+    sites_df["rank"] = np.arange(len(selected)) + 1
+    sites_df["marginal_gain"] = gains
+    logging.info(
+        "%s sites selected, mean population per reachable supermarket from %s "
+        "to %s, population without one from %s to %s",
+        len(sites_df),
+        round(float(np.mean(density)), 2),
+        round(float(np.mean(scorer.density())), 2),
+        round(float(unserved)),
+        round(float(scorer.population[scorer.counts == 0].sum())),
+    )
+    logging.info(sites_df.head(top_k))
+    sites_file = scoring_conf.get("sites_file")
+    write_table(
+        sites_df[["rank", "id", "lat", "lng", "gain", "marginal_gain"]], sites_file
+    )
+    logging.info("Selected sites written to %s", sites_file)
+    metrics.write()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="directory of the config file"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record cProfile stats and peak memory of every stage",
+    )
+    args = parser.parse_args()
+    try:
+        main(args.config, profile=args.profile)
+    except Exception:
+        logging.exception("Unhandled error during processing")
+        raise
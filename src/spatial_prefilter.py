@@ -0,0 +1,71 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371008.8  # Mean radius of earth in meter
+
+
+def to_unit_vectors(lat, lng):
+    """Convert geocodes into points on the unit sphere, so that Euclidean
+    nearest-neighbour search ranks points by great-circle distance.
+    """
+    lat = np.deg2rad(np.asarray(lat, dtype=float))
+    lng = np.deg2rad(np.asarray(lng, dtype=float))
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)]
+    )
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance in meter, broadcast over arrays."""
+    lat1, lng1, lat2, lng2 = (
+        np.deg2rad(np.asarray(value, dtype=float)) for value in (lat1, lng1, lat2, lng2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def search_radius(max_driving_time, max_speed):
+    """Farthest straight-line distance in meter that can be driven within
+    max_driving_time seconds at max_speed km/h.
+    """
+    return float(max_driving_time) * float(max_speed) / 3.6
+
+
+class StoreIndex:
+    def __init__(self, lat, lng):
+        """Initialization.
+        @param lat: latitudes of the stores
+        @param lng: longitudes of the stores
+
+        """
+        self.tree = cKDTree(to_unit_vectors(lat, lng))
+
+    def query_radius(self, lat, lng, radius):
+        """Indices of the stores within radius meter of each point, sorted
+        ascending so that candidates keep the order of the store list.
+        """
+        chord = 2 * np.sin(min(radius / EARTH_RADIUS, np.pi) / 2)
+        neighbours = self.tree.query_ball_point(to_unit_vectors(lat, lng), chord)
+        return [sorted(indices) for indices in neighbours]
+
+
+def find_candidates(grids, supermarkets, radius):
+    """Map each grid id to the supermarkets within radius meter of its center,
+    the only ones worth querying for driving time.
+    """
+    index = StoreIndex(
+        [float(supermarket["lat"]) for supermarket in supermarkets],
+        [float(supermarket["lng"]) for supermarket in supermarkets],
+    )
+    neighbours = index.query_radius(
+        [float(grid["center_lat"]) for grid in grids],
+        [float(grid["center_lng"]) for grid in grids],
+        radius,
+    )
+    return {
+        grid["id"]: [supermarkets[i] for i in indices]
+        for grid, indices in zip(grids, neighbours)
+    }
@@ -0,0 +1,175 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from spatial_prefilter import EARTH_RADIUS, haversine
+
+# Legal and filler words left out of the compared names
+STOP_WORDS = frozenset(["sdn", "bhd", "the", "and", "of", "at"])
+HASH_SHIFT = 1 << 31  # Room for a row index of buckets in the hash key
+
+
+def normalize_name(name):
+    """Lower case ASCII words of a store name, without accents, punctuation
+    and STOP_WORDS, so that "Tesco Extra (Penang) Sdn. Bhd." and
+    "TESCO extra penang" compare equal.
+    """
+    if not isinstance(name, str):
+        return ""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    words = re.sub(r"[^a-z0-9]+", " ", name.lower()).split()
+    return " ".join(word for word in words if word not in STOP_WORDS)
+
+
+def name_similarity(a, b):
+    """Similarity ratio in [0, 1] of two normalized names, 0 when their
+    numbers differ, as for the branches "Store 12" and "Store 13".
+    """
+    if a == b:
+        return 1.0
+    if not a or not b or re.findall(r"\d+", a) != re.findall(r"\d+", b):
+        return 0.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+class UnionFind:
+    def __init__(self, size):
+        """Initialization.
+        @param size: number of elements, each in its own set
+
+        """
+        self.parent = list(range(size))
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            # Path halving keeps the trees flat
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        """Merge the sets of i and j under the smaller root, so that every
+        set is labelled by its first element.
+        """
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+    def labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+
+def spatial_hash(lat, lng, cell_size):
+    """Bucket keys of the points on a lat/lng lattice whose cells are at
+    least cell_size meter wide, so that points within cell_size meter of
+    each other fall in the same or adjacent buckets.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    lat_step = np.rad2deg(cell_size / EARTH_RADIUS)
+    # Longitude degrees are shortest at the latitude farthest from the equator
+    cos_lat = max(np.cos(np.deg2rad(np.abs(lat).max())), 0.01) if len(lat) else 1.0
+    lng_step = lat_step / cos_lat
+    rows = np.floor(lat / lat_step).astype(np.int64)
+    columns = np.floor(lng / lng_step).astype(np.int64)
+    return columns * HASH_SHIFT + rows
+
+
+def neighbour_pairs(keys):
+    """Pairs (i, j), i < j, of points in the same or adjacent buckets, each
+    pair listed once. Buckets are only compared with their neighbours, so
+    the number of pairs grows with the number of points, not its square.
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    buckets = sorted_keys[starts]
+    bucket_of = np.repeat(np.arange(len(buckets)), counts)
+    first, second = [], []
+    # Half of the 3x3 neighbourhood, the other half pairs up the other way
+    for d_column, d_row in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        target = buckets + d_column * HASH_SHIFT + d_row
+        found = np.searchsorted(buckets, target)
+        found = np.minimum(found, len(buckets) - 1)
+        matched = buckets[found] == target
+        # Every point of a bucket against every point of its neighbour
+        neighbour = np.where(matched, found, -1)[bucket_of]
+        has = neighbour >= 0
+        sizes = np.where(has, counts[np.maximum(neighbour, 0)], 0)
+        left = np.repeat(np.arange(len(keys)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        right = starts[neighbour[left]] + offsets
+        if d_column == 0 and d_row == 0:
+            keep = left < right
+            left, right = left[keep], right[keep]
+        first.append(order[left])
+        second.append(order[right])
+    first, second = np.concatenate(first), np.concatenate(second)
+    return np.minimum(first, second), np.maximum(first, second)
+
+
+def cluster_stores(lat, lng, names, max_distance, min_similarity, place_ids=None):
+    """Label of the duplicate cluster of every store, the position of its
+    first record. Two records are duplicates when they share a place id, or
+    when they are within max_distance meter and their normalized names are
+    at least min_similarity alike, or when they share the exact location;
+    clusters are the transitive closure of the duplicate pairs.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    union_find = UnionFind(len(lat))
+    if not len(lat):
+        return union_find.labels()
+    if place_ids is not None:
+        first_of = {}
+        for i, place_id in enumerate(place_ids):
+            if isinstance(place_id, str) and place_id:
+                union_find.union(first_of.setdefault(place_id, i), i)
+    first, second = neighbour_pairs(spatial_hash(lat, lng, max_distance))
+    distances = haversine(lat[first], lng[first], lat[second], lng[second])
+    close = distances <= max_distance
+    first, second, distances = first[close], second[close], distances[close]
+    normalized = [normalize_name(name) for name in names]
+    for i, j, distance in zip(first.tolist(), second.tolist(), distances.tolist()):
+        if distance == 0 or (
+            name_similarity(normalized[i], normalized[j]) >= min_similarity
+        ):
+            union_find.union(i, j)
+    return union_find.labels()
+
+
+def deduplicate(stores_df, max_distance=50, min_similarity=0.8, type_priority=None):
+    """One record of every cluster of duplicate stores, with the number of
+    records of the cluster, in the order of stores_df. The kept record is
+    the first one of the type coming first in type_priority, e.g. the
+    supermarket record of a store also returned as a grocery, the first
+    one of the cluster without type_priority.
+    """
+    labels = cluster_stores(
+        stores_df["lat"].values,
+        stores_df["lng"].values,
+        stores_df["name"].values,
+        max_distance,
+        min_similarity,
+        stores_df["place_id"].values if "place_id" in stores_df else None,
+    )
+    rank = np.zeros(len(labels), dtype=np.int64)
+    if type_priority:
+        ranks = {store_type: i for i, store_type in enumerate(type_priority)}
+        rank = np.array(
+            [ranks.get(store_type, len(ranks)) for store_type in stores_df["type"]],
+            dtype=np.int64,
+        )
+    # Position of the best ranked record of each cluster, the earliest on ties
+    order = np.lexsort((np.arange(len(labels)), rank, labels))
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(sorted_labels != np.r_[-1, sorted_labels[:-1]])
+    kept = np.sort(order[starts])
+    records = np.bincount(labels, minlength=len(labels))
+    stores_df = stores_df.iloc[kept].copy()
+    stores_df["records"] = records[labels[kept]]
+    return stores_df
@@ -0,0 +1,155 @@
+import json
+
+import numpy as np
+import pandas as pd
+import shapefile as shp
+
+from projection import WEB_MERCATOR, WGS84, transform_coords
+
+BUILDING_TYPES = ["apartments", "residential", "bungalow", "detached", "house", "yes"]
+BUILDING_TYPE_WEIGHTS = [0.3, 0.25, 0.1, 0.1, 0.15, 0.1]
+
+
+def make_grid_lattice(
+    num_rows, num_cols, origin=(100.17, 5.12), cell_size=1000, num_districts=5
+):
+    """Lattice of square grids in EPSG:3857 as read from the grid file of
+    grid_population_layer_builder, i.e. id, left, top, right, bottom and
+    district. Districts are vertical bands of the lattice.
+    """
+    x0, y0 = transform_coords(origin[0], origin[1], WGS84, WEB_MERCATOR)
+    rows, cols = np.divmod(np.arange(num_rows * num_cols), num_cols)
+    band = np.minimum(cols * num_districts // max(num_cols, 1), num_districts - 1)
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_rows * num_cols) + 1,
+            "left": x0 + cols * cell_size,
+            "top": y0 + (rows + 1) * cell_size,
+            "right": x0 + (cols + 1) * cell_size,
+            "bottom": y0 + rows * cell_size,
+            "district": ["District %02d" % i for i in band],
+        }
+    )
+
+
+def grid_bounds(grid_df):
+    """(min_lng, min_lat, max_lng, max_lat) of a lattice."""
+    lng, lat = transform_coords(
+        [grid_df["left"].min(), grid_df["right"].max()],
+        [grid_df["bottom"].min(), grid_df["top"].max()],
+        WEB_MERCATOR,
+        WGS84,
+    )
+    return float(lng[0]), float(lat[0]), float(lng[1]), float(lat[1])
+
+
+def grid_layer(grid_df):
+    """GeoDataFrame of the grid polygons in EPSG:3857."""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    geometry = [
+        box(left, bottom, right, top)
+        for left, bottom, right, top in zip(
+            grid_df["left"], grid_df["bottom"], grid_df["right"], grid_df["top"]
+        )
+    ]
+    return gpd.GeoDataFrame(
+        grid_df[["id", "district"]].copy(), geometry=geometry, crs=WEB_MERCATOR
+    )
+
+
+def random_points(num_points, bounds, rng):
+    min_lng, min_lat, max_lng, max_lat = bounds
+    return (
+        rng.uniform(min_lng, max_lng, num_points),
+        rng.uniform(min_lat, max_lat, num_points),
+    )
+
+
+def make_buildings(num_buildings, bounds, rng):
+    """Residential buildings as written by osm_preprocessor."""
+    lng, lat = random_points(num_buildings, bounds, rng)
+    return pd.DataFrame(
+        {
+            "id": np.arange(num_buildings),
+            "name": "",
+            "type": rng.choice(BUILDING_TYPES, num_buildings, p=BUILDING_TYPE_WEIGHTS),
+            "area": rng.lognormal(np.log(150), 0.8, num_buildings),
+            "center_lng": lng,
+            "center_lat": lat,
+        }
+    )
+
+
+def write_building_shapefile(path, num_buildings, bounds, rng, max_vertices=12):
+    """Polygon shapefile of buildings in the layout of the OSM buildings
+    extract, with name and type fields and irregular footprints of 4 to
+    max_vertices vertices.
+    """
+    lng, lat = random_points(num_buildings, bounds, rng)
+    types = rng.choice(BUILDING_TYPES, num_buildings, p=BUILDING_TYPE_WEIGHTS)
+    num_vertices = rng.randint(4, max_vertices + 1, num_buildings)
+    writer = shp.Writer(path, shapeType=shp.POLYGON)
+    writer.field("name", "C", size=100)
+    writer.field("type", "C", size=20)
+    for i in range(num_buildings):
+        angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices[i]))
+        radius = rng.uniform(5e-5, 2e-4, num_vertices[i])
+        ring = np.column_stack(
+            [lng[i] + radius * np.cos(angles), lat[i] + radius * np.sin(angles)]
+        )
+        # Shapefile outer rings are clockwise and closed
+        ring = np.vstack([ring[::-1], ring[-1:]])
+        writer.poly([ring.tolist()])
+        writer.record("", types[i])
+    writer.close()
+
+
+def make_places(num_stores, bounds, rng):
+    """Raw Places API results as dumped by places_api_worker, with about one
+    result in ten repeated as another query would return it.
+    """
+    lng, lat = random_points(num_stores, bounds, rng)
+    places = []
+    for i in range(num_stores):
+        places.append(
+            {
+                "formatted_address": "%s Jalan Sintetik, Pulau Pinang, Malaysia" % i,
+                "geometry": {"location": {"lat": lat[i], "lng": lng[i]}},
+                "name": "Store %s" % i,
+                "place_id": "synthetic-%s" % i,
+                "place_type": "supermarket" if rng.rand() < 0.7 else "grocery",
+            }
+        )
+    duplicates = rng.choice(num_stores, num_stores // 10, replace=False)
+    return places + [dict(places[i], place_type="grocery") for i in duplicates]
+
+
+def write_distance_responses(path, grid_ids, store_ids, rng, max_driving_time=3600):
+    """Raw Distance Matrix responses as written by distance_api_worker, one
+    per (grid, store) pair, a few of them without any route.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for grid_id in grid_ids:
+            durations = rng.randint(60, max_driving_time, len(store_ids))
+            routed = rng.rand(len(store_ids)) > 0.02
+            for store_id, duration, ok in zip(store_ids, durations, routed):
+                response = {
+                    "destination_addresses": [],
+                    "origin_addresses": [],
+                    "rows": [],
+                    "status": "OK",
+                    "grid_id": str(grid_id),
+                    "supermarket_id": str(store_id),
+                }
+                if ok:
+                    element = {
+                        "distance": {"value": int(duration * 12)},
+                        "duration": {"value": int(duration)},
+                        "status": "OK",
+                    }
+                else:
+                    element = {"status": "ZERO_RESULTS"}
+                response["rows"].append({"elements": [element]})
+                f.write(json.dumps(response) + "\n")
@@ -0,0 +1,162 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from artifacts import read_table
+from distance_api_parser import iter_record_chunks
+from spatial_prefilter import haversine
+
+ESTIMATED_STATUS = "ESTIMATED"  # Status of the records of estimated pairs
+UNREACHABLE_STATUS = "UNREACHABLE"
+MIN_DISTANCE = 50  # in meter, floor of the straight-line distance of a pair
+
+
+def pair_features(distances, attributes=None):
+    """Design matrix of the estimator: intercept, log straight-line distance
+    and the grid attributes of each pair.
+    """
+    distances = np.maximum(np.asarray(distances, dtype=float), MIN_DISTANCE)
+    columns = [np.ones(len(distances)), np.log(distances)]
+    if attributes is not None:
+        columns += list(
+            np.asarray(attributes, dtype=float).reshape(len(distances), -1).T
+        )
+    return np.column_stack(columns)
+
+
+class TravelTimeEstimator:
+    def __init__(self, coef, lower, upper):
+        """Initialization.
+        @param coef: least-squares coefficients of log driving time on
+            pair_features
+        @param lower, upper: quantiles of the log residuals, the band of
+            driving times around each estimate
+
+        """
+        self.coef = np.asarray(coef, dtype=float)
+        self.lower = float(lower)
+        self.upper = float(upper)
+
+    @classmethod
+    def fit(cls, distances, times, attributes=None, coverage=0.98):
+        """Fit on routed pairs, the band holding coverage of the residuals."""
+        times = np.asarray(times, dtype=float)
+        routed = np.isfinite(times) & (times > 0)
+        features = pair_features(distances, attributes)[routed]
+        if len(features) <= features.shape[1]:
+            raise ValueError(
+                "%s routed pairs are too few to fit the estimator" % len(features)
+            )
+        log_times = np.log(times[routed])
+        coef = np.linalg.lstsq(features, log_times, rcond=None)[0]
+        residuals = log_times - features @ coef
+        lower, upper = np.percentile(
+            residuals, [50 * (1 - coverage), 50 * (1 + coverage)]
+        )
+        return cls(coef, lower, upper)
+
+    def predict(self, distances, attributes=None):
+        """Estimated driving time in seconds of each pair, with the low and
+        high ends of its band.
+        """
+        log_times = pair_features(distances, attributes) @ self.coef
+        return (
+            np.exp(log_times),
+            np.exp(log_times + self.lower),
+            np.exp(log_times + self.upper),
+        )
+
+    def borderline(self, distances, thresholds, attributes=None):
+        """Estimated driving times and whether the band of each pair holds
+        any of the thresholds, the pairs worth querying.
+        """
+        estimates, low, high = self.predict(distances, attributes)
+        borderline = np.zeros(len(estimates), dtype=bool)
+        for threshold in thresholds:
+            borderline |= (low <= threshold) & (high > threshold)
+        return estimates, borderline
+
+
+def grid_attributes(population_file, columns, grid_ids):
+    """Log1p of the columns of the grid population table for each grid id,
+    0 for the grids missing from the table, None without any column.
+    """
+    if not columns:
+        return None
+    if not population_file or not os.path.exists(population_file):
+        logging.warning(
+            "Grid population file %s not found, grid attributes skipped",
+            population_file,
+        )
+        return None
+    population_df = read_table(population_file, columns=["id"] + list(columns))
+    population_df["id"] = pd.to_numeric(population_df["id"]).astype(np.int64)
+    population_df = population_df.drop_duplicates("id").set_index("id")
+    ids = pd.to_numeric(pd.Series(grid_ids)).astype(np.int64)
+    values = population_df.reindex(ids)[list(columns)].values.astype(float)
+    return np.log1p(np.nan_to_num(np.maximum(values, 0)))
+
+
+def training_pairs(raw_file, grid_positions, store_positions):
+    """Positions of the grid and store and driving time of every pair
+    routed by the API in the responses of raw_file, leaving out the
+    estimated and unreachable records and the unknown grids and stores.
+    """
+    grids, stores, times = [], [], []
+    for dist_df in iter_record_chunks(raw_file, 100000):
+        dist_df = dist_df.loc[
+            ~dist_df["status"].isin([ESTIMATED_STATUS, UNREACHABLE_STATUS])
+            & dist_df["driving_time"].notna()
+        ]
+        grid = dist_df["grid_id"].map(grid_positions)
+        store = dist_df["supermarket_id"].map(store_positions)
+        known = grid.notna() & store.notna()
+        grids.append(grid[known].values.astype(np.int64))
+        stores.append(store[known].values.astype(np.int64))
+        times.append(dist_df["driving_time"].values[known.values])
+    if not times:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    return np.concatenate(grids), np.concatenate(stores), np.concatenate(times)
+
+
+def pair_distances(grid_lat, grid_lng, store_lat, store_lng, grids, stores):
+    return haversine(
+        grid_lat[grids], grid_lng[grids], store_lat[stores], store_lng[stores]
+    )
+
+
+def store_counts(raw_file, max_driving_time):
+    """Number of supermarkets within max_driving_time of each grid id."""
+    counts = []
+    for dist_df in iter_record_chunks(raw_file, 100000):
+        within = dist_df.loc[dist_df["driving_time"] <= max_driving_time]
+        counts.append(within.groupby("grid_id").size())
+    if not counts:
+        return pd.Series(dtype=np.int64)
+    return pd.concat(counts).groupby(level=0).sum()
+
+
+def count_error(raw_file, reference_file, thresholds):
+    """Error of the per-grid store counts within each driving time of
+    thresholds of the responses of raw_file against those of a full run in
+    reference_file.
+    """
+    errors = {}
+    for threshold in thresholds:
+        counts = store_counts(raw_file, threshold)
+        reference = store_counts(reference_file, threshold)
+        grid_ids = counts.index.union(reference.index)
+        counts = counts.reindex(grid_ids, fill_value=0)
+        reference = reference.reindex(grid_ids, fill_value=0)
+        diff = (counts - reference).abs()
+        errors[threshold] = {
+            "grids": len(grid_ids),
+            "mean_abs_error": round(float(diff.mean()), 4) if len(diff) else 0.0,
+            "max_abs_error": int(diff.max()) if len(diff) else 0,
+            "exact_share": round(float((diff == 0).mean()), 4) if len(diff) else 1.0,
+            "stores_counted": int(counts.sum()),
+            "stores_reference": int(reference.sum()),
+        }
+    return errors
@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+
+DECAY_FUNCTIONS = ("exponential", "gaussian", "linear")
+
+
+class TravelTimeMatrix:
+    def __init__(self, grid_ids, store_ids, indptr, indices, times, distances):
+        """Initialization.
+        @param grid_ids: sorted ids of the grids, one row each
+        @param store_ids: sorted ids of the stores, one column each
+        @param indptr, indices: CSR structure of the routed pairs, the
+            stores of row i being indices[indptr[i]:indptr[i + 1]]
+        @param times: driving time in seconds of each routed pair
+        @param distances: driving distance in meter of each routed pair
+
+        """
+        self.grid_ids = np.asarray(grid_ids)
+        self.store_ids = np.asarray(store_ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.times = np.asarray(times, dtype=float)
+        self.distances = np.asarray(distances, dtype=float)
+        # Row of every stored pair, so that row-wise reductions are bincounts
+        self.rows = np.repeat(np.arange(len(self.grid_ids)), np.diff(self.indptr))
+
+    @classmethod
+    def from_records(cls, grid_ids, store_ids, times, distances, store_values=None):
+        """Build the matrix from parsed distance records, keeping the
+        fastest route of repeated pairs and dropping the unrouted ones.
+        When store_values is given, store_ids are positions in it, so that
+        the ids are not repeated for every record.
+        """
+        times = np.asarray(times, dtype=float)
+        routed = ~np.isnan(times)
+        grid_values, rows = np.unique(np.asarray(grid_ids)[routed], return_inverse=True)
+        # Store ids are kept as strings so that the matrix saves without pickle
+        if store_values is None:
+            store_values, cols = np.unique(
+                np.asarray(store_ids).astype(str)[routed], return_inverse=True
+            )
+        else:
+            store_values, ranks = np.unique(
+                np.asarray(store_values).astype(str), return_inverse=True
+            )
+            cols = ranks[np.asarray(store_ids)[routed]]
+        times = times[routed]
+        distances = np.asarray(distances, dtype=float)[routed]
+        order = np.lexsort((times, cols, rows))
+        rows, cols = rows[order], cols[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols = rows[first], cols[first]
+        indptr = np.zeros(len(grid_values) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(grid_values)), out=indptr[1:])
+        return cls(
+            grid_values,
+            store_values,
+            indptr,
+            cols,
+            times[order][first],
+            distances[order][first],
+        )
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(
+            path,
+            grid_ids=self.grid_ids,
+            store_ids=self.store_ids,
+            indptr=self.indptr,
+            indices=self.indices,
+            times=self.times,
+            distances=self.distances,
+        )
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(
+            arrays["grid_ids"],
+            arrays["store_ids"],
+            arrays["indptr"],
+            arrays["indices"],
+            arrays["times"],
+            arrays["distances"],
+        )
+
+    def rows_of(self, grid_ids):
+        """Row of each grid id, -1 for the grids without any routed pair."""
+        grid_ids = np.asarray(grid_ids)
+        if not len(self.grid_ids):
+            return np.full(len(grid_ids), -1, dtype=np.int64)
+        rows = np.minimum(
+            np.searchsorted(self.grid_ids, grid_ids), len(self.grid_ids) - 1
+        )
+        return np.where(self.grid_ids[rows] == grid_ids, rows, -1)
+
+    def counts(self, thresholds):
+        """Stores within each threshold of driving time of every row, one
+        column per threshold in seconds.
+        """
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+        num_bands = len(thresholds)
+        # A pair meets the thresholds from its band upwards, so each pair is
+        # counted once in its band and the bands summed
+        bands = np.searchsorted(np.sort(thresholds), self.times, side="left")
+        within = bands < num_bands
+        counts = np.bincount(
+            self.rows[within] * num_bands + bands[within],
+            minlength=len(self.grid_ids) * num_bands,
+        ).reshape(len(self.grid_ids), num_bands)
+        counts = np.cumsum(counts, axis=1)
+        return counts[:, np.argsort(np.argsort(thresholds))]
+
+    def density(self, grid_ids, population, thresholds):
+        """Population per store within each threshold, or the whole
+        population of the grid when no store is, one column per threshold.
+        """
+        counts = self.counts(thresholds)
+        rows = self.rows_of(grid_ids)
+        grid_counts = np.zeros((len(rows), counts.shape[1]), dtype=np.int64)
+        grid_counts[rows >= 0] = counts[rows[rows >= 0]]
+        population = np.asarray(population, dtype=float)[:, None]
+        return population / np.maximum(grid_counts, 1)
+
+    def accessibility(self, grid_ids, decay="exponential", scale=600, weights=None):
+        """Sum over the reachable stores of a decay function of the driving
+        time, with scale in seconds, optionally weighted per store column.
+        """
+        if decay not in DECAY_FUNCTIONS:
+            raise ValueError("Unknown decay function: %s" % decay)
+        ratio = self.times / float(scale)
+        if decay == "exponential":
+            values = np.exp(-ratio)
+        elif decay == "gaussian":
+            values = np.exp(-0.5 * ratio**2)
+        else:
+            values = np.clip(1 - ratio, 0, None)
+        if weights is not None:
+            values = values * np.asarray(weights, dtype=float)[self.indices]
+        scores = np.bincount(self.rows, values, minlength=len(self.grid_ids))
+        rows = self.rows_of(grid_ids)
+        return np.where(rows >= 0, scores[np.maximum(rows, 0)], 0.0)